@@ -0,0 +1 @@
+%~dp0\python.exe -m rec2_bisect --action bisect %*
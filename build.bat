@@ -1 +1 @@
-%~dp0\python.exe -m rec2_bisect --action build
+%~dp0\python.exe -m rec2_bisect --action build %*
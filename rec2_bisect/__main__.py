@@ -4,6 +4,7 @@ import pathlib
 import platform
 import sys
 
+from . import trace
 from .rec2 import REC2
 
 REC2_BISECT_ROOT = pathlib.Path(__file__).parent
@@ -15,20 +16,40 @@ def win32_error_messagebox(message: str, title: str):
 
 def main():
     sys.path.append(str(REC2_BISECT_ROOT.parent))
-    from rec2_bisect import dep_manager
     if platform.system() != "Windows":
         print("rec2_bisect is only supported on Windows")
         return 1
     parser = argparse.ArgumentParser(allow_abbrev=False)
-    parser.add_argument("--action", required=True, choices=("download", "build", "run", "debug"),
-                        help="Argument can be download, build, or run")
+    parser.add_argument("--action", required=True, choices=("download", "build", "run", "debug", "bisect", "cache", "ccache-stats"),
+                        help="Argument can be download, build, run, debug, bisect, cache or ccache-stats")
+    parser.add_argument("--good", metavar="COMMIT", help="Known good commit (bisect)")
+    parser.add_argument("--bad", metavar="COMMIT", default="HEAD", help="Known bad commit (bisect, default: HEAD)")
+    parser.add_argument("--recheck", action="store_true", help="Probe all dependencies, even when they did not change")
+    parser.add_argument("--reconfigure", action="store_true",
+                        help="Run cmake configure before building, even when its inputs did not change")
+    parser.add_argument("--trace", metavar="PATH", type=pathlib.Path,
+                        help=f"Write a Chrome trace of all phases to PATH (or set {trace.TRACE_ENV})")
     # parser.add_argument("arguments", metavar="ARG", nargs="*", help="Argument of 'run'")
     args = parser.parse_args()
 
     # if args.arguments and args.action not in ("run", "debug"):
     #     parser.error("Arguments are accepted with 'run' action")
+    if args.action == "bisect" and not args.good:
+        parser.error("--good is required with 'bisect' action")
+    if args.trace:
+        trace.enable(args.trace)
+
+    rec2 = None
+    if args.action == "run" and not args.recheck:
+        # Fast path: running an earlier build of HEAD needs neither the dependencies nor the toolchain
+        with trace.span("create REC2"):
+            rec2 = REC2.create(reconfigure=args.reconfigure)
+        if rec2.run_cached([]):
+            return 0
 
-    deps_available = dep_manager.check_install_dependencies()
+    from rec2_bisect import dep_manager
+    with trace.span("check dependencies"):
+        deps_available = dep_manager.check_install_dependencies(recheck=args.recheck)
     if args.action != "download" and not all(deps_available.values()):
         missing_deps = list(name for name, avail in deps_available.items() if not avail)
         win32_error_messagebox(
@@ -44,10 +65,14 @@ def main():
             print("Remove the 'deps' folder manually before running this command again.")
             return 1
 
-        dep_manager.download_extract_dependencies()
+        with trace.span("download dependencies"):
+            dep_manager.download_extract_dependencies([name for name, avail in deps_available.items() if not avail])
         return 0
 
-    rec2 = REC2.create()
+    if rec2 is None:
+        with trace.span("create REC2"):
+            rec2 = REC2.create(reconfigure=args.reconfigure)
+    rec2.migrate_legacy_builds()
     if args.action == "run":
         rec2.run([])
         return 0
@@ -57,6 +82,16 @@ def main():
     elif args.action == "build":
         rec2.build()
         return 0
+    elif args.action == "bisect":
+        from .bisect import bisect
+        bisect(rec2, good=args.good, bad=args.bad)
+        return 0
+    elif args.action == "cache":
+        rec2.cache_info()
+        return 0
+    elif args.action == "ccache-stats":
+        rec2.ccache_stats()
+        return 0
     else:
         parser.error("Unknown action!")
 
@@ -0,0 +1,313 @@
+import dataclasses
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+import time
+from typing import IO, Callable, Optional
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+BLOB_CODECS: dict[str, Callable[[Path, str], IO[bytes]]] = {
+    "none": lambda path, mode: open(path, mode),
+    "gz": lambda path, mode: gzip.open(path, mode, compresslevel=6),
+}
+if lzma:
+    BLOB_CODECS["xz"] = lambda path, mode: lzma.open(path, mode, preset=3) if "w" in mode else lzma.open(path, mode)
+DEFAULT_CODEC = "xz" if lzma else "gz"
+# Checksums of the files in run/<key>/, with their size and mtime when they were verified
+RUN_MANIFEST_NAME = ".verified.json"
+# Builds of the cache layout before the blob store: <root>/<commit hash>/ with plain copies of the artifacts
+LEGACY_ENTRY_RE = re.compile(r"[0-9a-f]{40}|[0-9a-f]{64}")
+# Raised while decompressing a damaged blob
+BLOB_ERRORS: tuple[type[Exception], ...] = (OSError, EOFError) + ((lzma.LZMAError,) if lzma else ())
+
+
+@dataclasses.dataclass(frozen=True)
+class ArtifactFile:
+    name: str
+    sha256: str
+    size: int
+    codec: str = "none"
+
+
+@dataclasses.dataclass(frozen=True)
+class CacheEntry:
+    key: str
+    files: tuple[ArtifactFile, ...]
+    last_used: float
+    commit: Optional[str] = None
+
+
+@dataclasses.dataclass(frozen=True)
+class CacheStats:
+    entries: int
+    blobs: int
+    blobs_size: int
+    logical_size: int
+    max_size: int
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def fsync_file(path: Path) -> None:
+    with path.open("r+b") as f:
+        os.fsync(f.fileno())
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    """Hardlink src to dst when the file system allows it, otherwise copy it"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def blob_sha256(path: Path, codec: str) -> str:
+    """Digest of the decompressed content of a blob: the digest of the artifact it stores"""
+    h = hashlib.sha256()
+    with BLOB_CODECS[codec](path, "rb") as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class ArtifactCache:
+    """
+    Content-addressed store of build artifacts.
+
+    Every distinct file is stored once, compressed, in blobs/<sha256>.<codec>, and every key (a source tree key)
+    gets a small manifest in manifests/<key>.json mapping artifact names to blobs.
+    aliases/<commit> maps commit hashes to keys.
+    The manifest mtime is the last time the key was used, for LRU eviction.
+    Artifacts are decompressed on demand into run/<key>/ (uncompressed blobs are hardlinked), together with
+    a checksum manifest that lets later runs trust them without hashing them again.
+
+    Blobs and manifests are written to temporary files, flushed to disk and renamed into place. The manifest of
+    a key is written last: an interrupted store leaves unreferenced blobs (removed by gc), never a partial entry.
+    """
+    def __init__(self, root: Path, max_size: int, codec: str = DEFAULT_CODEC):
+        self.root = root
+        self.max_size = max_size
+        self.codec = codec
+        self.blobs_path = root / "blobs"
+        self.manifests_path = root / "manifests"
+        self.aliases_path = root / "aliases"
+        self.run_path = root / "run"
+
+    def blob_path(self, digest: str, codec: str) -> Path:
+        suffix = "" if codec == "none" else f".{codec}"
+        return self.blobs_path / digest[:2] / f"{digest}{suffix}"
+
+    def manifest_path(self, key: str) -> Path:
+        return self.manifests_path / f"{key}.json"
+
+    def _write_atomic(self, path: Path, data: bytes, durable: bool = False) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _store_blob(self, path: Path) -> ArtifactFile:
+        digest = file_sha256(path)
+        blob_path = self.blob_path(digest, self.codec)
+        if not blob_path.is_file():
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=blob_path.parent, prefix=".tmp-")
+            os.close(fd)
+            try:
+                with path.open("rb") as fsrc, BLOB_CODECS[self.codec](Path(tmp), "wb") as fdst:
+                    shutil.copyfileobj(fsrc, fdst, 1 << 20)
+                fsync_file(Path(tmp))
+                os.replace(tmp, blob_path)
+            finally:
+                Path(tmp).unlink(missing_ok=True)
+        return ArtifactFile(name=path.name, sha256=digest, size=path.stat().st_size, codec=self.codec)
+
+    def set_alias(self, commit: str, key: str) -> None:
+        self._write_atomic(self.aliases_path / commit, key.encode())
+
+    def resolve_alias(self, commit: str) -> Optional[str]:
+        try:
+            return (self.aliases_path / commit).read_text().strip()
+        except FileNotFoundError:
+            return None
+
+    def store(self, key: str, files: list[Path], commit: Optional[str] = None) -> None:
+        self.add_entry(key, [self._store_blob(path) for path in files], commit=commit)
+
+    def add_entry(self, key: str, artifacts: list[ArtifactFile], commit: Optional[str] = None) -> None:
+        """Write the manifest of key, for artifacts whose blobs are stored already"""
+        manifest = {
+            "commit": commit,
+            "files": {a.name: {"sha256": a.sha256, "size": a.size, "codec": a.codec} for a in artifacts},
+        }
+        self._write_atomic(self.manifest_path(key), json.dumps(manifest, indent=1).encode(), durable=True)
+        self.gc()
+
+    def _read_entry(self, key: str) -> Optional[CacheEntry]:
+        manifest_path = self.manifest_path(key)
+        try:
+            manifest = json.loads(manifest_path.read_text())
+            last_used = manifest_path.stat().st_mtime
+        except (FileNotFoundError, ValueError):
+            return None
+        files = tuple(ArtifactFile(name=name, sha256=f["sha256"], size=f["size"], codec=f.get("codec", "none"))
+                      for name, f in manifest["files"].items())
+        return CacheEntry(key=key, files=files, last_used=last_used, commit=manifest.get("commit"))
+
+    def entry(self, key: str) -> Optional[CacheEntry]:
+        return self._read_entry(key)
+
+    def contains(self, key: str, names: list[str]) -> bool:
+        entry = self._read_entry(key)
+        if not entry:
+            return False
+        available = {f.name for f in entry.files if self.blob_path(f.sha256, f.codec).is_file()}
+        return all(name in available for name in names)
+
+    def materialize(self, key: str, names: list[str]) -> Optional[Path]:
+        """Make the named artifacts of key available under their real names, and return their directory"""
+        entry = self._read_entry(key)
+        if not entry:
+            return None
+        os.utime(self.manifest_path(key))
+        files = {f.name: f for f in entry.files}
+        dest_path = self.run_path / key
+        dest_path.mkdir(parents=True, exist_ok=True)
+        verified = self._read_run_manifest(dest_path)
+        changed = False
+        for name in names:
+            if name not in files:
+                continue
+            artifact = files[name]
+            dest = dest_path / name
+            if self._is_verified(dest, artifact, verified.get(name)):
+                continue
+            blob_path = self.blob_path(artifact.sha256, artifact.codec)
+            if not blob_path.is_file():
+                return None
+            # Reuse an earlier decompressed copy, as long as it was not modified
+            if not (dest.is_file() and dest.stat().st_size == artifact.size and file_sha256(dest) == artifact.sha256):
+                self._extract_blob(blob_path, artifact, dest)
+            stat = dest.stat()
+            verified[name] = {"sha256": artifact.sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            changed = True
+        if changed:
+            self._write_atomic(dest_path / RUN_MANIFEST_NAME, json.dumps(verified, indent=1).encode())
+        return dest_path
+
+    @staticmethod
+    def _read_run_manifest(dest_path: Path) -> dict[str, dict]:
+        try:
+            return json.loads((dest_path / RUN_MANIFEST_NAME).read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def _is_verified(dest: Path, artifact: ArtifactFile, record: Optional[dict]) -> bool:
+        if not record or record.get("sha256") != artifact.sha256:
+            return False
+        try:
+            stat = dest.stat()
+        except FileNotFoundError:
+            return False
+        return stat.st_size == record.get("size") == artifact.size and stat.st_mtime_ns == record.get("mtime_ns")
+
+    def _extract_blob(self, blob_path: Path, artifact: ArtifactFile, dest: Path) -> None:
+        fd, tmp = tempfile.mkstemp(dir=dest.parent, prefix=".tmp-")
+        os.close(fd)
+        try:
+            if artifact.codec == "none":
+                Path(tmp).unlink()
+                link_or_copy(blob_path, Path(tmp))
+            else:
+                with BLOB_CODECS[artifact.codec](blob_path, "rb") as fsrc, open(tmp, "wb") as fdst:
+                    shutil.copyfileobj(fsrc, fdst, 1 << 20)
+            os.replace(tmp, dest)
+        finally:
+            Path(tmp).unlink(missing_ok=True)
+
+    def legacy_entries(self) -> list[Path]:
+        """Directories of builds stored by versions before the blob store, to be migrated with store()"""
+        if not self.root.is_dir():
+            return []
+        return sorted(p for p in self.root.iterdir() if p.is_dir() and LEGACY_ENTRY_RE.fullmatch(p.name))
+
+    def entries(self) -> list[CacheEntry]:
+        if not self.manifests_path.is_dir():
+            return []
+        entries = (self._read_entry(p.stem) for p in self.manifests_path.glob("*.json"))
+        return sorted((e for e in entries if e), key=lambda e: e.last_used)
+
+    def _blob_sizes(self) -> dict[str, int]:
+        if not self.blobs_path.is_dir():
+            return {}
+        return {p.name: p.stat().st_size for p in self.blobs_path.glob("*/*") if not p.name.startswith(".tmp-")}
+
+    def stats(self) -> CacheStats:
+        entries = self.entries()
+        blob_sizes = self._blob_sizes()
+        return CacheStats(
+            entries=len(entries),
+            blobs=len(blob_sizes),
+            blobs_size=sum(blob_sizes.values()),
+            logical_size=sum(f.size for e in entries for f in e.files),
+            max_size=self.max_size,
+        )
+
+    def remove(self, key: str) -> None:
+        self.manifest_path(key).unlink(missing_ok=True)
+        shutil.rmtree(self.run_path / key, ignore_errors=True)
+
+    def _referenced_blobs(self, entries: list[CacheEntry]) -> set[str]:
+        return {self.blob_path(f.sha256, f.codec).name for e in entries for f in e.files}
+
+    def gc(self) -> None:
+        entries = self.entries()
+        blob_sizes = self._blob_sizes()
+        referenced = self._referenced_blobs(entries)
+        total_size = sum(size for name, size in blob_sizes.items() if name in referenced)
+        # Evict least recently used entries until the blobs only they reference fit the budget.
+        # The most recently used entry is always kept.
+        evicted_blobs = set()
+        while total_size > self.max_size and len(entries) > 1:
+            evicted = entries.pop(0)
+            evicted_blobs.update(self._referenced_blobs([evicted]))
+            print(f"Evicting {evicted.key} from the artifact cache")
+            self.remove(evicted.key)
+            referenced = self._referenced_blobs(entries)
+            total_size = sum(size for name, size in blob_sizes.items() if name in referenced)
+        # Leave other recent unreferenced blobs alone: they may belong to a manifest that another process
+        # is about to write
+        now = time.time()
+        for name in blob_sizes:
+            if name in referenced:
+                continue
+            blob_path = self.blobs_path / name[:2] / name
+            if name in evicted_blobs or now - blob_path.stat().st_mtime > 60 * 60:
+                blob_path.unlink(missing_ok=True)
@@ -0,0 +1,115 @@
+import subprocess
+from typing import Callable, Optional
+
+from .commit_index import CommitIndex
+from .git_util import git_active_branch, git_checkout, git_hash, git_rev_parse
+from .rec2 import REC2
+
+
+def popcount(mask: int) -> int:
+    return bin(mask).count("1")
+
+
+def ancestor_masks(commits: list[str], parents: Callable[[str], list[str]]) -> dict[str, int]:
+    """
+    Ancestors (inclusive) of every commit as a bit set over commits.
+
+    commits is topologically ordered, oldest first; bit i is commits[i]. Parents outside commits are ignored.
+    """
+    masks: dict[str, int] = {}
+    for i, commit in enumerate(commits):
+        mask = 1 << i
+        for parent in parents(commit):
+            mask |= masks.get(parent, 0)
+        masks[commit] = mask
+    return masks
+
+
+def choose_bisect_commit(testable: list[str], candidates: int, masks: dict[str, int],
+                         is_cached: Callable[[str], bool]) -> str:
+    # Like git bisect: a commit reaching r of the n candidates leaves r (bad) or n - r (good) of them,
+    # so the best commit maximizes min(r, n - r). An already built commit is preferred as long as it removes
+    # at least half as many candidates as the best one: a cache hit saves a full configure + build.
+    total = popcount(candidates)
+
+    def score(commit: str) -> int:
+        reach = popcount(masks[commit] & candidates)
+        return min(reach, total - reach)
+
+    scores = {commit: score(commit) for commit in testable}
+    best = max(testable, key=lambda commit: scores[commit])
+    if is_cached(best):
+        return best
+    good_enough = sorted((commit for commit in testable if 2 * scores[commit] >= scores[best]),
+                         key=lambda commit: scores[commit], reverse=True)
+    for commit in good_enough:
+        if is_cached(commit):
+            return commit
+    return best
+
+
+def ask_verdict(commit: str) -> str:
+    while True:
+        answer = input(f"Is {commit} [g]ood, [b]ad or [s]kip? ([q]uit) ").strip().lower()
+        if answer in ("g", "good", "b", "bad", "s", "skip", "q", "quit"):
+            return answer[0]
+
+
+def bisect(rec2: REC2, good: str, bad: str) -> Optional[str]:
+    original_ref = git_active_branch(rec2.source_path) or git_hash(rec2.source_path)
+    good_hash = git_rev_parse(rec2.source_path, good)
+    bad_hash = git_rev_parse(rec2.source_path, bad)
+    index = CommitIndex(rec2.cache_path / "commits.sqlite", rec2.source_path)
+    index.update(bad_hash)
+    commits = index.range(good_hash, bad_hash)
+    commits.reverse()
+    if not commits:
+        index.close()
+        raise ValueError(f"{bad} is not a descendant of {good}")
+    # The history between good and bad can contain merges: candidates are pruned by ancestry, not by position
+    order = [commit.hash for commit in commits]
+    masks = ancestor_masks(order, index.parents)
+    index.close()
+    bits = {commit: 1 << i for i, commit in enumerate(order)}
+    first_bad = bad_hash
+    candidates = masks[bad_hash] & ~bits[bad_hash]
+    skipped: set[str] = set()
+    try:
+        while True:
+            testable = [commit for commit in order if candidates & bits[commit] and commit not in skipped]
+            if not testable:
+                break
+            commit = choose_bisect_commit(testable, candidates, masks, rec2.has_cached_build)
+            cached = "cached" if rec2.has_cached_build(commit) else "needs build"
+            print(f"Bisecting: {len(testable)} commits left to test ({cached}: {commit})")
+            git_checkout(rec2.source_path, commit)
+            try:
+                rec2.run([])
+            except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
+                # Broken commits fail to build, or build without the rec2 outputs: skip them, keep the session
+                print(f"Building or running {commit} failed ({e}). Skipping it.")
+                skipped.add(commit)
+                continue
+            verdict = ask_verdict(commit)
+            if verdict == "q":
+                return None
+            if verdict == "g":
+                # The culprit is not an ancestor of a good commit
+                candidates &= ~masks[commit]
+            elif verdict == "b":
+                # The culprit is the bad commit or one of its ancestors
+                first_bad = commit
+                candidates &= masks[commit] & ~bits[commit]
+            else:
+                skipped.add(commit)
+    finally:
+        git_checkout(rec2.source_path, original_ref)
+
+    candidates = [commit for commit in order if candidates & bits[commit]]
+    if candidates:
+        print("The first bad commit could be any of:")
+        for commit in candidates + [first_bad]:
+            print(f"  {commit}")
+        return None
+    print(f"{first_bad} is the first bad commit")
+    return first_bad
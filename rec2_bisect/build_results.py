@@ -0,0 +1,204 @@
+import dataclasses
+import datetime
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Optional
+
+from .ninja_log import NinjaLogEntry
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    hash TEXT NOT NULL,
+    what TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    duration REAL NOT NULL,
+    exit_code INTEGER,
+    finished TEXT NOT NULL,
+    PRIMARY KEY (hash, what)
+);
+CREATE TABLE IF NOT EXISTS ninja_edges (
+    hash TEXT NOT NULL,
+    what TEXT NOT NULL,
+    output TEXT NOT NULL,
+    start_ms INTEGER NOT NULL,
+    end_ms INTEGER NOT NULL,
+    PRIMARY KEY (hash, what, output)
+);
+CREATE INDEX IF NOT EXISTS ninja_edges_output ON ninja_edges (what, output);
+"""
+
+# Columns added after the first version of the schema: added to existing databases when opened
+OPTIONAL_COLUMNS = {
+    "estimated_tus": "INTEGER",
+    "actual_tus": "INTEGER",
+    "tree_key": "TEXT",
+    "checkout_duration": "REAL",
+    "configure_duration": "REAL",
+    "build_duration": "REAL",
+    "dll_size": "INTEGER",
+    "pdb_size": "INTEGER",
+    "injector_size": "INTEGER",
+}
+
+# Metrics of a result that are tracked over history (scripts/build_results.py regressions)
+METRICS = ("duration", "configure_duration", "build_duration", "dll_size", "pdb_size", "injector_size")
+
+
+@dataclasses.dataclass(frozen=True)
+class BuildResult:
+    hash: str
+    what: str
+    position: int
+    subject: str
+    outcome: str
+    duration: float
+    exit_code: Optional[int]
+    finished: str
+    estimated_tus: Optional[int] = None
+    actual_tus: Optional[int] = None
+    tree_key: Optional[str] = None
+    checkout_duration: Optional[float] = None
+    configure_duration: Optional[float] = None
+    build_duration: Optional[float] = None
+    dll_size: Optional[int] = None
+    pdb_size: Optional[int] = None
+    injector_size: Optional[int] = None
+
+    @property
+    def log_line(self) -> str:
+        return f"{self.outcome:<4} {self.hash} {self.subject}"
+
+
+@dataclasses.dataclass(frozen=True)
+class EdgeTiming:
+    """Duration of one ninja edge (e.g. compiling a translation unit) in the build of a commit"""
+    hash: str
+    what: str
+    output: str
+    duration_ms: int
+    position: Optional[int]
+
+
+class BuildResults:
+    """
+    Results of history sweeps, one row per commit and toolchain (--what of build_history.py).
+
+    position is the index of the commit in the (oldest first) commit list of the sweep.
+    """
+    def __init__(self, db_path: Path):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.executescript(SCHEMA)
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(results)")}
+            for column, column_type in OPTIONAL_COLUMNS.items():
+                if column not in columns:
+                    self.db.execute(f"ALTER TABLE results ADD COLUMN {column} {column_type}")
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def record(self, commit: str, what: str, position: int, subject: str, outcome: str, duration: float,
+               exit_code: Optional[int], estimated_tus: Optional[int] = None,
+               actual_tus: Optional[int] = None, tree_key: Optional[str] = None,
+               checkout_duration: Optional[float] = None, configure_duration: Optional[float] = None,
+               build_duration: Optional[float] = None, dll_size: Optional[int] = None,
+               pdb_size: Optional[int] = None, injector_size: Optional[int] = None) -> BuildResult:
+        result = BuildResult(
+            hash=commit,
+            what=what,
+            position=position,
+            subject=subject,
+            outcome=outcome,
+            duration=duration,
+            exit_code=exit_code,
+            finished=datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            estimated_tus=estimated_tus,
+            actual_tus=actual_tus,
+            tree_key=tree_key,
+            checkout_duration=checkout_duration,
+            configure_duration=configure_duration,
+            build_duration=build_duration,
+            dll_size=dll_size,
+            pdb_size=pdb_size,
+            injector_size=injector_size,
+        )
+        fields = dataclasses.asdict(result)
+        with self.lock, self.db:
+            self.db.execute(f"INSERT OR REPLACE INTO results ({', '.join(fields)}) "
+                            f"VALUES ({', '.join('?' * len(fields))})", tuple(fields.values()))
+        return result
+
+    def record_ninja_log(self, commit: str, what: str, entries: list[NinjaLogEntry]) -> None:
+        """Link the .ninja_log entries written by the build of commit to it"""
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO ninja_edges VALUES (?, ?, ?, ?, ?)",
+                                [(commit, what, entry.output, entry.start_ms, entry.end_ms) for entry in entries])
+
+    def edge_timings(self, what: str, output: Optional[str] = None) -> list[EdgeTiming]:
+        """Recorded edges in commit order (edges of commits without a sweep result last, in recording order)"""
+        query = """
+            SELECT e.hash, e.what, e.output, e.end_ms - e.start_ms, r.position FROM ninja_edges e
+            LEFT JOIN results r ON r.hash = e.hash AND r.what = e.what
+            WHERE e.what = ? AND (? IS NULL OR e.output = ?)
+            ORDER BY r.position IS NULL, r.position, e.rowid
+        """
+        with self.lock:
+            return [EdgeTiming(*row) for row in self.db.execute(query, (what, output, output))]
+
+    def edge_toolchains(self) -> list[str]:
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT DISTINCT what FROM ninja_edges ORDER BY what")]
+
+    def merge(self, db_path: Path) -> int:
+        """Copy the results and ninja edges of another results database; rows that exist already are kept"""
+        BuildResults(db_path).close()  # Bring its schema up to date
+        columns = ", ".join(field.name for field in dataclasses.fields(BuildResult))
+        with self.lock:
+            self.db.execute("ATTACH DATABASE ? AS other", (str(db_path),))
+            try:
+                with self.db:
+                    count = self.db.execute(f"INSERT OR IGNORE INTO results ({columns}) "
+                                            f"SELECT {columns} FROM other.results").rowcount
+                    self.db.execute("INSERT OR IGNORE INTO ninja_edges (hash, what, output, start_ms, end_ms) "
+                                    "SELECT hash, what, output, start_ms, end_ms FROM other.ninja_edges")
+            finally:
+                self.db.execute("DETACH DATABASE other")
+        return count
+
+    def _query(self, query: str, params: tuple = ()) -> list[BuildResult]:
+        with self.lock:
+            cursor = self.db.execute(query, params)
+            names = [description[0] for description in cursor.description]
+            return [BuildResult(**dict(zip(names, row))) for row in cursor]
+
+    def completed(self, what: str) -> set[str]:
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT hash FROM results WHERE what = ?", (what,))}
+
+    def find_tree_key(self, what: str, tree_key: str, exclude: str) -> Optional[BuildResult]:
+        """Result of another commit (not exclude) with the same build inputs"""
+        results = self._query("SELECT * FROM results WHERE what = ? AND tree_key = ? AND hash != ? "
+                              "AND outcome != 'SKIP' ORDER BY position LIMIT 1", (what, tree_key, exclude))
+        return results[0] if results else None
+
+    def toolchains(self) -> list[str]:
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT DISTINCT what FROM results ORDER BY what")]
+
+    def results(self, what: Optional[str] = None, outcome: Optional[str] = None) -> list[BuildResult]:
+        query = "SELECT * FROM results WHERE (? IS NULL OR what = ?) AND (? IS NULL OR outcome = ?) ORDER BY what, position"
+        return self._query(query, (what, what, outcome, outcome))
+
+    def first_fail_after_last_ok(self, what: str) -> Optional[BuildResult]:
+        query = """
+            SELECT * FROM results WHERE what = ? AND outcome = 'FAIL' AND position > (
+                SELECT COALESCE(MAX(position), -1) FROM results WHERE what = ? AND outcome = 'OK'
+            ) ORDER BY position LIMIT 1
+        """
+        results = self._query(query, (what, what))
+        return results[0] if results else None
@@ -0,0 +1,154 @@
+import datetime
+from pathlib import Path
+import sqlite3
+import subprocess
+from typing import Optional
+
+from .git_util import GitCommitSummary, git_rev_parse
+from .trace import span
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS commits (
+    hash TEXT PRIMARY KEY,
+    date TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    generation INTEGER NOT NULL,
+    subject TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS commits_timestamp ON commits(timestamp);
+CREATE TABLE IF NOT EXISTS parents (
+    hash TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (hash, position)
+);
+CREATE INDEX IF NOT EXISTS parents_parent ON parents(parent);
+CREATE TABLE IF NOT EXISTS tips (
+    hash TEXT PRIMARY KEY
+);
+"""
+
+ANCESTORS_CTE = """
+ancestors_{name}(hash) AS (
+    SELECT ?
+    UNION
+    SELECT parents.parent FROM parents JOIN ancestors_{name} ON parents.hash = ancestors_{name}.hash
+)
+"""
+
+
+class CommitIndex:
+    """
+    Local SQLite index of the commit graph of a repository: hash, parents, author date and subject.
+
+    update() only walks the commits that are not reachable from previously indexed tips.
+    The generation number (1 + the largest generation of the parents) orders commits topologically.
+    """
+    def __init__(self, db_path: Path, repo_path: Path):
+        self.repo_path = repo_path
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __contains__(self, commit: str) -> bool:
+        return self.db.execute("SELECT 1 FROM commits WHERE hash = ?", (commit,)).fetchone() is not None
+
+    def update(self, rev: str = "HEAD") -> int:
+        tip = git_rev_parse(self.repo_path, rev)
+        if tip in self:
+            return 0
+        known_tips = [row[0] for row in self.db.execute("SELECT hash FROM tips")]
+        with span("git log (commit index)", "git"):
+            output = subprocess.check_output(
+                ["git", "log", "--reverse", "--topo-order", "--format=%H%x00%P%x00%aI%x00%at%x00%s", tip, "--not"] + known_tips,
+                cwd=self.repo_path, text=True, encoding="utf-8", errors="replace")
+        generations: dict[str, int] = {}
+        new_parents: set[str] = set()
+        count = 0
+        with self.db:
+            for line in output.splitlines(keepends=False):
+                commit_hash, parents, date, timestamp, subject = line.split("\0", 4)
+                parents = parents.split()
+                new_parents.update(parents)
+                generation = 1 + max((self._generation(p, generations) for p in parents), default=0)
+                generations[commit_hash] = generation
+                self.db.execute("INSERT OR REPLACE INTO commits VALUES (?, ?, ?, ?, ?)",
+                                (commit_hash, date, int(timestamp), generation, subject))
+                self.db.executemany("INSERT OR REPLACE INTO parents VALUES (?, ?, ?)",
+                                    ((commit_hash, parent, position) for position, parent in enumerate(parents)))
+                count += 1
+            # Tips that are ancestors of the new tip are redundant: the new tip excludes them in the next update
+            self.db.executemany("DELETE FROM tips WHERE hash = ?",
+                                ((known_tip,) for known_tip in known_tips if known_tip in new_parents))
+            self.db.execute("INSERT OR REPLACE INTO tips VALUES (?)", (tip,))
+        return count
+
+    def _generation(self, commit: str, generations: dict[str, int]) -> int:
+        if commit in generations:
+            return generations[commit]
+        row = self.db.execute("SELECT generation FROM commits WHERE hash = ?", (commit,)).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _summaries(rows) -> list[GitCommitSummary]:
+        return [
+            GitCommitSummary(hash=commit_hash, date=datetime.datetime.fromisoformat(date), subject=subject)
+            for commit_hash, date, subject in rows
+        ]
+
+    def get(self, commit: str) -> Optional[GitCommitSummary]:
+        rows = self.db.execute("SELECT hash, date, subject FROM commits WHERE hash = ?", (commit,)).fetchall()
+        summaries = self._summaries(rows)
+        return summaries[0] if summaries else None
+
+    def parents(self, commit: str) -> list[str]:
+        return [row[0] for row in self.db.execute(
+            "SELECT parent FROM parents WHERE hash = ? ORDER BY position", (commit,))]
+
+    def children(self, commit: str) -> list[str]:
+        return [row[0] for row in self.db.execute("SELECT hash FROM parents WHERE parent = ?", (commit,))]
+
+    def log(self, tip: str) -> list[GitCommitSummary]:
+        """All ancestors of tip (inclusive), newest first"""
+        return self.range(None, tip)
+
+    def range(self, old: Optional[str], new: str) -> list[GitCommitSummary]:
+        """Commits reachable from new but not from old (like git log old..new), newest first"""
+        if old is None:
+            query = (f"WITH RECURSIVE {ANCESTORS_CTE.format(name='new')} "
+                     "SELECT hash, date, subject FROM commits WHERE hash IN ancestors_new "
+                     "ORDER BY generation DESC, timestamp DESC")
+            return self._summaries(self.db.execute(query, (new,)))
+        query = (f"WITH RECURSIVE {ANCESTORS_CTE.format(name='new')}, {ANCESTORS_CTE.format(name='old')} "
+                 "SELECT hash, date, subject FROM commits "
+                 "WHERE hash IN ancestors_new AND hash NOT IN ancestors_old "
+                 "ORDER BY generation DESC, timestamp DESC")
+        return self._summaries(self.db.execute(query, (new, old)))
+
+    def between_dates(self, start: datetime.datetime, end: datetime.datetime) -> list[GitCommitSummary]:
+        """Commits authored in [start, end), newest first"""
+        query = ("SELECT hash, date, subject FROM commits WHERE timestamp >= ? AND timestamp < ? "
+                 "ORDER BY timestamp DESC, generation DESC")
+        return self._summaries(self.db.execute(query, (int(start.timestamp()), int(end.timestamp()))))
+
+    def is_ancestor(self, ancestor: str, commit: str) -> bool:
+        """True when ancestor is reachable from commit (a commit is its own ancestor)"""
+        row = self.db.execute("SELECT generation FROM commits WHERE hash = ?", (ancestor,)).fetchone()
+        if row is None:
+            return False
+        # Commits with a lower generation than the ancestor cannot reach it: stop walking there
+        query = """
+            WITH RECURSIVE reachable(hash) AS (
+                SELECT ?
+                UNION
+                SELECT parents.parent FROM parents
+                JOIN reachable ON parents.hash = reachable.hash
+                JOIN commits ON commits.hash = parents.parent
+                WHERE commits.generation >= ?
+            )
+            SELECT 1 FROM reachable WHERE hash = ?
+        """
+        return self.db.execute(query, (commit, row[0], ancestor)).fetchone() is not None
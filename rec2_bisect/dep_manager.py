@@ -1,23 +1,132 @@
-from rec2_bisect.packages.cmake import has_cmake, download_extract_cmake
-from rec2_bisect.packages.git import has_git, download_extract_git
-from rec2_bisect.packages.msvc import has_msvc, download_extract_msvc
-from rec2_bisect.packages.ninja import has_ninja, download_extract_ninja
-
-
-def check_install_dependencies() -> dict[str, bool]:
-    result = {
-        "cmake": has_cmake(),
-        "git": has_git(),
-        "msvc": has_msvc(arch="x86"),
-        "ninja": has_ninja(),
-    }
-    for name, r in result.items():
-        print(f"{name:<20}{'yes' if r else 'no'}")
-    return result
-
-
-def download_extract_dependencies() -> None:
-    download_extract_cmake()
-    download_extract_git()
-    download_extract_ninja()
-    download_extract_msvc(arch="x86")
+import concurrent.futures
+import json
+import os
+from pathlib import Path
+import typing
+
+from rec2_bisect.packages.ccache import CCACHE_EXE_PATH, CCACHE_ROOT, CcacheConfig, has_ccache, download_extract_ccache
+from rec2_bisect.packages.cmake import CMAKE_EXE_PATH, CMAKE_ROOT, has_cmake, download_extract_cmake
+from rec2_bisect.packages.git import GIT_EXE_PATH, GIT_ROOT, has_git, download_extract_git
+from rec2_bisect.packages.msvc import has_msvc, download_extract_msvc, msvc_fingerprint
+from rec2_bisect.packages.ninja import NINJA_EXE_PATH, NINJA_ROOT, has_ninja, download_extract_ninja
+from rec2_bisect.paths import REC2_DEPS_ROOT
+from rec2_bisect.trace import span
+
+PROBE_PATH = REC2_DEPS_ROOT / "probe.json"
+
+
+def path_fingerprint(*paths: Path) -> typing.Optional[list]:
+    fingerprint = []
+    for path in paths:
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        fingerprint.append([str(path), st.st_size, st.st_mtime_ns])
+    return fingerprint
+
+
+DEPENDENCIES = {
+    "cmake": (has_cmake, lambda: path_fingerprint(CMAKE_ROOT, CMAKE_EXE_PATH)),
+    "git": (has_git, lambda: path_fingerprint(GIT_ROOT, GIT_EXE_PATH)),
+    "msvc": (lambda: has_msvc(arch="x86"), lambda: msvc_fingerprint(arch="x86")),
+    "ninja": (has_ninja, lambda: path_fingerprint(NINJA_ROOT, NINJA_EXE_PATH)),
+}
+# Only needed when enabled in config.ini
+OPTIONAL_DEPENDENCIES = {
+    "ccache": (has_ccache, lambda: path_fingerprint(CCACHE_ROOT, CCACHE_EXE_PATH)),
+}
+
+DOWNLOAD_JOBS = {
+    "cmake": download_extract_cmake,
+    "git": download_extract_git,
+    "ninja": download_extract_ninja,
+    "msvc": lambda: download_extract_msvc(arch="x86"),
+    "ccache": download_extract_ccache,
+}
+
+
+def ccache_enabled() -> bool:
+    return CcacheConfig.load().enabled
+
+
+def enabled_dependencies() -> dict[str, tuple]:
+    dependencies = dict(DEPENDENCIES)
+    if ccache_enabled():
+        dependencies["ccache"] = OPTIONAL_DEPENDENCIES["ccache"]
+    return dependencies
+
+
+def _read_probe() -> dict:
+    try:
+        return json.loads(PROBE_PATH.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _probe(name: str, probe: typing.Callable[[], bool]) -> bool:
+    with span(f"probe {name}", "dependencies"):
+        return probe()
+
+
+def _download_extract(name: str, job: typing.Callable[[], None]) -> None:
+    with span(f"download {name}", "dependencies"):
+        job()
+
+
+def check_install_dependencies(recheck: bool = False) -> dict[str, bool]:
+    """
+    Check which dependencies are usable.
+
+    A dependency is only probed (--version, the MSVC self-test) when the fingerprint of its install directory
+    differs from the one recorded in deps/probe.json, or when recheck is set. Probes run concurrently.
+    Only successful probes are recorded: a dependency that failed its probe is probed again on the next check.
+    """
+    dependencies = enabled_dependencies()
+    probe = {} if recheck else _read_probe()
+    fingerprints = {name: fingerprint() for name, (_, fingerprint) in dependencies.items()}
+    result = {}
+    stale = []
+    for name in dependencies:
+        recorded = probe.get(name)
+        if fingerprints[name] is None:
+            # Not installed
+            result[name] = False
+        elif isinstance(recorded, dict) and recorded.get("fingerprint") == fingerprints[name] and recorded.get("available"):
+            result[name] = True
+        else:
+            stale.append(name)
+    if stale:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(stale)) as executor:
+            futures = {name: executor.submit(_probe, name, dependencies[name][0]) for name in stale}
+            for name, future in futures.items():
+                result[name] = future.result()
+        records = {
+            name: {"fingerprint": fingerprints[name], "available": result[name]}
+            for name in dependencies if result[name]
+        }
+        if REC2_DEPS_ROOT.is_dir():
+            tmp_path = PROBE_PATH.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps(records, indent=2))
+            os.replace(tmp_path, PROBE_PATH)
+    for name in dependencies:
+        print(f"{name:<20}{'yes' if result[name] else 'no'}")
+    return {name: result[name] for name in dependencies}
+
+
+def download_extract_dependencies(names: typing.Optional[list[str]] = None) -> None:
+    """Download and extract the named dependencies (default: all enabled ones)"""
+    # Every dependency is downloaded and extracted in its own thread: extraction of one starts
+    # as soon as its own download has finished.
+    jobs = {name: DOWNLOAD_JOBS[name] for name in (names or enabled_dependencies())}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = {executor.submit(_download_extract, name, job): name for name, job in jobs.items()}
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"[!] {futures[future]} failed: {e}")
+                failed.append(futures[future])
+    if failed:
+        raise RuntimeError(f"Failed to download {', '.join(sorted(failed))}")
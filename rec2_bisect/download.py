@@ -0,0 +1,165 @@
+import configparser
+import dataclasses
+import os
+from pathlib import Path
+import shutil
+import time
+from typing import Optional
+import urllib.error
+import urllib.request
+import zipfile
+
+from rec2_bisect.artifact_cache import file_sha256
+from rec2_bisect.paths import REC2_CONFIG_PATH
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_ATTEMPTS = 5
+
+
+@dataclasses.dataclass(frozen=True)
+class DownloadConfig:
+    mirror: Optional[str]
+    digests: dict[str, str]
+
+    @classmethod
+    def load(cls) -> "DownloadConfig":
+        config = configparser.ConfigParser()
+        if REC2_CONFIG_PATH.is_file():
+            with REC2_CONFIG_PATH.open() as f:
+                config.read_file(f)
+        mirror = config.get("download", "mirror", fallback="").strip() or None
+        digests = {}
+        if config.has_section("download"):
+            for key, value in config.items("download"):
+                if key.endswith("_sha256") and value.strip():
+                    digests[key.removesuffix("_sha256")] = value.strip().lower()
+        return cls(mirror=mirror, digests=digests)
+
+
+def _download_resumable(url: str, path: Path, name: str) -> None:
+    """Download url to path, continuing an earlier partial download in path.part with an HTTP Range request"""
+    part_path = path.with_name(path.name + ".part")
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        offset = part_path.stat().st_size if part_path.is_file() else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+        try:
+            with urllib.request.urlopen(request) as stream:
+                if offset and stream.status != 206:
+                    # The server ignored the Range header: start again
+                    offset = 0
+                total = offset + int(stream.headers.get("Content-Length") or 0)
+                size = offset
+                reported = size * 10 // total if total else 0
+                with part_path.open("ab" if offset else "wb") as f:
+                    while True:
+                        block = stream.read(DOWNLOAD_CHUNK_SIZE)
+                        if not block:
+                            break
+                        f.write(block)
+                        size += len(block)
+                        if total and size * 10 // total > reported:
+                            reported = size * 10 // total
+                            print(f"[ ] Downloading {name} ... {reported * 10}%")
+            if total and size < total:
+                raise ConnectionError(f"connection closed after {size} of {total} bytes")
+            os.replace(part_path, path)
+            return
+        except urllib.error.HTTPError as e:
+            if e.code == 416:
+                # Range not satisfiable: the partial file is stale or complete, start again
+                part_path.unlink(missing_ok=True)
+                continue
+            raise
+        except (urllib.error.URLError, ConnectionError, TimeoutError) as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            print(f"[!] Downloading {name} interrupted ({e}), resuming ...")
+            time.sleep(attempt)
+    raise ConnectionError(f"Downloading {name} failed after {DOWNLOAD_ATTEMPTS} attempts")
+
+
+def _verify(path: Path, name: str, sha256: Optional[str]) -> str:
+    digest = file_sha256(path)
+    if sha256 and digest != sha256:
+        path.unlink()
+        raise ValueError(f"SHA-256 mismatch for {name}: expected {sha256}, got {digest}")
+    return digest
+
+
+def _read_digest(path: Path) -> Optional[str]:
+    try:
+        return path.read_text().split()[0].lower()
+    except (FileNotFoundError, IndexError):
+        return None
+
+
+def download_file(url: str, path: Path, name: str, sha256: Optional[str] = None) -> None:
+    """
+    Download url to path, verifying its SHA-256 digest.
+
+    The digest is pinned by the caller, or by `<name>_sha256` in the [download] section of config.ini.
+    When [download] mirror is set, the file is looked up there first: in a directory (for example a network share)
+    or below a http(s) URL. A http(s) mirror is only used for files with a known digest. Files downloaded from
+    upstream are copied into a mirror directory, with a `<file>.sha256` digest that also verifies later mirror
+    copies of unpinned files.
+    """
+    config = DownloadConfig.load()
+    sha256 = (sha256 or config.digests.get(name.lower()) or "").lower() or None
+    _, filename = url.rsplit("/", 1)
+    mirror = config.mirror
+    if sha256 and path.is_file() and file_sha256(path) == sha256:
+        print(f"[x] {name} was downloaded already")
+        return
+
+    if mirror and not mirror.startswith(("http://", "https://")):
+        mirror_path = Path(mirror) / filename
+        expected = sha256 or _read_digest(mirror_path.with_name(filename + ".sha256"))
+        if mirror_path.is_file() and expected:
+            print(f"[ ] Copying {name} from {mirror_path} ...")
+            shutil.copyfile(mirror_path, path)
+            try:
+                _verify(path, name, expected)
+                return
+            except ValueError as e:
+                print(f"[!] {e}: downloading it instead")
+        _download_resumable(url, path, name)
+        digest = _verify(path, name, sha256)
+        try:
+            Path(mirror).mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(path, mirror_path.with_name(filename + ".tmp"))
+            os.replace(mirror_path.with_name(filename + ".tmp"), mirror_path)
+            mirror_path.with_name(filename + ".sha256").write_text(f"{digest}  {filename}\n")
+        except OSError as e:
+            print(f"[!] Could not add {name} to mirror {mirror}: {e}")
+        return
+
+    if mirror and not sha256:
+        print(f"[!] The SHA-256 digest of {name} is unknown: not downloading it from mirror {mirror}")
+    elif mirror:
+        try:
+            _download_resumable(f"{mirror.rstrip('/')}/{filename}", path, name)
+            _verify(path, name, sha256)
+            return
+        except (urllib.error.URLError, ValueError) as e:
+            print(f"[!] {name} is not available from mirror {mirror} ({e}): downloading it from {url}")
+    if not sha256:
+        print(f"[!] The SHA-256 digest of {name} is unknown: it is not verified")
+    _download_resumable(url, path, name)
+    _verify(path, name, sha256)
+
+
+def extract_zip(zip_path: Path, target_path: Path, prefix: str = "") -> None:
+    """Extract the members of zip_path below prefix into target_path, streaming every member to disk"""
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            if not info.filename.startswith(prefix):
+                continue
+            target = target_path / info.filename.removeprefix(prefix)
+            if info.is_dir():
+                target.mkdir(parents=True, exist_ok=True)
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with zf.open(info) as fsrc, target.open("wb") as fdst:
+                shutil.copyfileobj(fsrc, fdst, DOWNLOAD_CHUNK_SIZE)
@@ -1,8 +1,12 @@
+import atexit
 import dataclasses
 import datetime
-import io
 from pathlib import Path
 import subprocess
+import threading
+from typing import IO, Optional
+
+from .trace import span
 
 
 @dataclasses.dataclass(frozen=True)
@@ -21,69 +25,331 @@ class GitCommitDetails:
     contents: str
 
 
+@dataclasses.dataclass(frozen=True)
+class GitCommitObject:
+    hash: str
+    tree: str
+    parents: tuple[str, ...]
+    author: str
+    author_date: datetime.datetime
+    committer_date: datetime.datetime
+    message: str
+
+    @property
+    def subject(self) -> str:
+        paragraph, _, _ = self.message.strip("\n").partition("\n\n")
+        return " ".join(line.strip() for line in paragraph.splitlines())
+
+
+def parse_git_signature(value: str) -> tuple[str, datetime.datetime]:
+    person, timestamp, tz = value.rsplit(" ", 2)
+    sign = -1 if tz[0] == "-" else 1
+    offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+    tzinfo = datetime.timezone(sign * offset)
+    return person, datetime.datetime.fromtimestamp(int(timestamp), tz=tzinfo)
+
+
+def parse_git_commit(commit_hash: str, data: bytes) -> GitCommitObject:
+    header, _, message = data.decode("utf-8", errors="replace").partition("\n\n")
+    tree = ""
+    parents = []
+    author = ""
+    author_date = committer_date = datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)
+    for line in header.splitlines():
+        key, _, value = line.partition(" ")
+        if key == "tree":
+            tree = value
+        elif key == "parent":
+            parents.append(value)
+        elif key == "author":
+            author, author_date = parse_git_signature(value)
+        elif key == "committer":
+            _, committer_date = parse_git_signature(value)
+    return GitCommitObject(
+        hash=commit_hash,
+        tree=tree,
+        parents=tuple(parents),
+        author=author,
+        author_date=author_date,
+        committer_date=committer_date,
+        message=message,
+    )
+
+
+@dataclasses.dataclass(frozen=True)
+class GitTreeEntry:
+    mode: str
+    name: str
+    hash: str
+
+    @property
+    def is_tree(self) -> bool:
+        return self.mode == "40000"
+
+
+def parse_git_tree(data: bytes, hash_size: int) -> list[GitTreeEntry]:
+    entries = []
+    pos = 0
+    while pos < len(data):
+        space = data.index(b" ", pos)
+        nul = data.index(b"\0", space)
+        entries.append(GitTreeEntry(
+            mode=data[pos:space].decode(),
+            name=data[space + 1:nul].decode("utf-8", errors="surrogateescape"),
+            hash=data[nul + 1:nul + 1 + hash_size].hex(),
+        ))
+        pos = nul + 1 + hash_size
+    return entries
+
+
+MAX_SYMREF_DEPTH = 5
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+
+def find_git_dir(path: Path) -> Optional[Path]:
+    """Git directory of the work tree containing path, found without running git (`.git` directory or gitdir file)"""
+    for directory in (path, *path.parents):
+        dot_git = directory / ".git"
+        if dot_git.is_dir():
+            return dot_git
+        if dot_git.is_file():
+            content = dot_git.read_text().strip()
+            if not content.startswith("gitdir: "):
+                return None
+            return (directory / content.removeprefix("gitdir: ")).resolve()
+    return None
+
+
+def _read_packed_ref(common_dir: Path, ref: str) -> Optional[str]:
+    try:
+        with (common_dir / "packed-refs").open() as f:
+            for line in f:
+                if line.startswith(("#", "^")):
+                    continue
+                object_hash, _, name = line.rstrip("\n").partition(" ")
+                if name == ref:
+                    return object_hash
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def read_git_ref(git_dir: Path, ref: str) -> Optional[str]:
+    """
+    Resolve ref (e.g. HEAD or refs/heads/master) by reading the files of git_dir: loose refs, then packed-refs.
+
+    Linked worktrees keep HEAD in their own git directory and share the other refs through `commondir`.
+    Returns None when the ref cannot be resolved this way (e.g. a reftable repository): ask git instead.
+    """
+    common_dir = git_dir
+    try:
+        common_dir = (git_dir / (git_dir / "commondir").read_text().strip()).resolve()
+    except FileNotFoundError:
+        pass
+    for _ in range(MAX_SYMREF_DEPTH):
+        value = None
+        for base in (git_dir, common_dir):
+            try:
+                value = (base / ref).read_text().strip()
+                break
+            except OSError:
+                continue
+        if value is None:
+            value = _read_packed_ref(common_dir, ref)
+        if value is None:
+            return None
+        if value.startswith("ref: "):
+            ref = value.removeprefix("ref: ")
+            continue
+        if len(value) in (40, 64) and HEX_DIGITS.issuperset(value):
+            return value
+        return None
+    return None
+
+
+def read_git_head(path: Path) -> Optional[str]:
+    """Commit hash of HEAD of the work tree at path, without running git"""
+    git_dir = find_git_dir(path)
+    return read_git_ref(git_dir, "HEAD") if git_dir else None
+
+
+class GitSession:
+    """
+    Long-lived `git cat-file --batch-check` and `git cat-file --batch` processes for one repository.
+
+    Refs are resolved again by git for every request, so checkouts in between are picked up.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._processes: dict[str, subprocess.Popen] = {}
+        self._git_dir: Optional[Path] = None
+
+    def _process(self, mode: str) -> subprocess.Popen:
+        process = self._processes.get(mode)
+        if process is None or process.poll() is not None:
+            with span(f"git cat-file {mode} (start)", "git"):
+                process = subprocess.Popen(["git", "cat-file", mode], cwd=self.path,
+                                           stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._processes[mode] = process
+        return process
+
+    @staticmethod
+    def _request(process: subprocess.Popen, rev: str) -> Optional[tuple[str, str, int]]:
+        stdin: IO[bytes] = process.stdin
+        stdout: IO[bytes] = process.stdout
+        stdin.write(rev.encode() + b"\n")
+        stdin.flush()
+        reply = stdout.readline().decode().rstrip("\n")
+        if not reply:
+            raise OSError("git cat-file exited unexpectedly")
+        parts = reply.split(" ")
+        if len(parts) != 3:
+            # "<rev> missing" or "<rev> ambiguous"
+            return None
+        object_hash, object_type, object_size = parts
+        return object_hash, object_type, int(object_size)
+
+    def object_info(self, rev: str) -> Optional[tuple[str, str, int]]:
+        with self._lock:
+            return self._request(self._process("--batch-check"), rev)
+
+    def read_object(self, rev: str) -> Optional[tuple[str, str, bytes]]:
+        with self._lock:
+            process = self._process("--batch")
+            info = self._request(process, rev)
+            if info is None:
+                return None
+            object_hash, object_type, object_size = info
+            data = process.stdout.read(object_size + 1)[:-1]
+            return object_hash, object_type, data
+
+    def rev_parse(self, rev: str) -> str:
+        info = self.object_info(f"{rev}^{{commit}}")
+        if info is None:
+            raise ValueError(f"Unknown commit: {rev}")
+        return info[0]
+
+    def read_commit(self, rev: str) -> GitCommitObject:
+        result = self.read_object(f"{rev}^{{commit}}")
+        if result is None:
+            raise ValueError(f"Unknown commit: {rev}")
+        object_hash, _, data = result
+        return parse_git_commit(object_hash, data)
+
+    def read_tree(self, rev: str) -> list[GitTreeEntry]:
+        result = self.read_object(f"{rev}^{{tree}}")
+        if result is None:
+            raise ValueError(f"Unknown tree: {rev}")
+        object_hash, _, data = result
+        return parse_git_tree(data, hash_size=len(object_hash) // 2)
+
+    @property
+    def git_dir(self) -> Path:
+        if self._git_dir is None:
+            git_dir = find_git_dir(self.path)
+            if git_dir is None:
+                git_dir = subprocess.check_output(["git", "rev-parse", "--git-dir"], cwd=self.path, text=True).strip()
+            self._git_dir = (self.path / git_dir).resolve()
+        return self._git_dir
+
+    def active_branch(self) -> str:
+        head = (self.git_dir / "HEAD").read_text().strip()
+        return head.removeprefix("ref: refs/heads/") if head.startswith("ref: refs/heads/") else ""
+
+    def close(self) -> None:
+        with self._lock:
+            for process in self._processes.values():
+                process.stdin.close()
+                process.wait()
+            self._processes.clear()
+
+
+_sessions: dict[Path, GitSession] = {}
+
+
+def git_session(path: Path) -> GitSession:
+    key = path.resolve()
+    session = _sessions.get(key)
+    if session is None:
+        session = _sessions[key] = GitSession(key)
+    return session
+
+
+@atexit.register
+def _close_git_sessions() -> None:
+    for session in _sessions.values():
+        session.close()
+    _sessions.clear()
+
+
 def git_clone_repo(path: Path, url: str):
     subprocess.check_call(["git", "clone", url, str(path)], cwd=path)
 
 
+def git_rev_parse(path: Path, rev: str) -> str:
+    return git_session(path).rev_parse(rev)
+
+
 def git_hash(path: Path):
-    return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path, text=True).strip()
+    return read_git_head(path) or git_rev_parse(path, "HEAD")
 
 
 def git_is_clean(path: Path) -> bool:
     try:
-        subprocess.check_call(["git", "status", "--porcelain"], stdout=subprocess.DEVNULL, cwd=path)
+        with span("git status", "git"):
+            subprocess.check_call(["git", "status", "--porcelain"], stdout=subprocess.DEVNULL, cwd=path)
         return True
     except subprocess.CalledProcessError:
         return False
 
 
+def git_local_changes(path: Path) -> list[str]:
+    """Modified, staged and untracked files of the working tree (git status --porcelain lines)"""
+    with span("git status", "git"):
+        output = subprocess.check_output(["git", "status", "--porcelain"], cwd=path, text=True)
+    return output.splitlines()
+
+
 def git_active_branch(path: Path) -> str:
-    return subprocess.check_output(["git", "branch", "--show-current"], cwd=path, text=True).strip()
+    return git_session(path).active_branch()
+
+
+def git_checkout(path: Path, commit: str) -> None:
+    with span("git checkout", "git", commit=commit):
+        subprocess.check_call(["git", "checkout", "--quiet", commit], cwd=path)
 
 
 def git_clean(path: Path, force: bool = True) -> None:
-    subprocess.check_call(["git", "clean"] + ["-f"] if force else [], cwd=path)
+    with span("git clean", "git"):
+        subprocess.check_call(["git", "clean"] + ["-f"] if force else [], cwd=path)
 
 
 def git_log(path: Path, branch: str) -> list[GitCommitSummary]:
-    output = subprocess.check_output(["git", "log", branch, "--pretty=\"%H,%aI,%s\""], cwd=path, text=True)
+    # A single `git log` walks the history much faster than reading every commit through the cat-file session
+    with span("git log", "git", rev=branch):
+        output = subprocess.check_output(["git", "log", "-z", "--format=%H%x1f%aI%x1f%s", branch], cwd=path,
+                                         text=True, encoding="utf-8", errors="replace")
     commits = []
-    for line in output.splitlines(keepends=False):
-        commit_hash, commit_date, commit_subject = line.split(",", 2)
-        commits.append(
-            GitCommitSummary(
-                hash=commit_hash,
-                date=datetime.datetime.fromisoformat(commit_date),
-                subject=commit_subject)
-        )
+    for record in output.split("\0"):
+        if not record:
+            continue
+        commit_hash, commit_date, commit_subject = record.split("\x1f", 2)
+        commits.append(GitCommitSummary(hash=commit_hash, date=datetime.datetime.fromisoformat(commit_date),
+                                        subject=commit_subject))
     return commits
 
 
 def git_show_commit(path: Path, commit: str) -> GitCommitDetails:
-    reader = io.StringIO(subprocess.check_output(["git", "show", commit], cwd=path, text=True))
-    commit_hash = "<unknown>"
-    commit_author = "<unknown>"
-    commit_date = "<unknown>"
-    commit_message = ""
-    commit_contents = ""
-    while True:
-        line = reader.readline()
-        if line.startswith("commit"):
-            commit_hash = line.removeprefix("commit").strip()
-        elif line.startswith("Author:"):
-            commit_author = line.removeprefix("Author:").strip()
-        elif line.startswith("Date: "):
-            commit_date = line.removeprefix("Date:").strip()
-        elif line.startswith(" "):
-            commit_message += line
-        else:
-            commit_contents += line
-            break
-    commit_contents += reader.read()
+    commit_object = git_session(path).read_commit(commit)
+    date = commit_object.author_date
+    # cat-file cannot produce diffs: the patch still comes from git show
+    with span("git show", "git", commit=commit_object.hash):
+        contents = subprocess.check_output(["git", "show", "--format=", commit_object.hash], cwd=path, text=True)
     return GitCommitDetails(
-        hash=commit_hash,
-        author=commit_author,
-        date=commit_date,
-        message=commit_message,
-        contents=commit_contents,
+        hash=commit_object.hash,
+        author=commit_object.author,
+        date=f"{date:%a %b} {date.day} {date:%H:%M:%S %Y %z}",
+        message=commit_object.message,
+        contents=contents,
     )
@@ -0,0 +1,74 @@
+import dataclasses
+import os
+from pathlib import Path
+from typing import Optional
+
+OBJECT_SUFFIXES = (".obj", ".o")
+# Bytes before the end of the log remembered to recognize it again
+NINJA_LOG_TAIL_SIZE = 256
+
+
+@dataclasses.dataclass(frozen=True)
+class NinjaLogEntry:
+    start_ms: int
+    end_ms: int
+    output: str
+    command_hash: str
+
+    @property
+    def duration_ms(self) -> int:
+        return self.end_ms - self.start_ms
+
+    @property
+    def is_object(self) -> bool:
+        return self.output.endswith(OBJECT_SUFFIXES)
+
+
+@dataclasses.dataclass(frozen=True)
+class NinjaLogPosition:
+    """End of .ninja_log before a build, with what identifies the file: ninja recompacts it into a new file"""
+    inode: int = 0
+    size: int = 0
+    tail: bytes = b""
+
+
+def ninja_log_position(build_path: Path) -> NinjaLogPosition:
+    try:
+        with (build_path / ".ninja_log").open("rb") as f:
+            stat = os.fstat(f.fileno())
+            f.seek(max(stat.st_size - NINJA_LOG_TAIL_SIZE, 0))
+            return NinjaLogPosition(inode=stat.st_ino, size=stat.st_size, tail=f.read(NINJA_LOG_TAIL_SIZE))
+    except FileNotFoundError:
+        return NinjaLogPosition()
+
+
+def read_ninja_log(build_path: Path, position: NinjaLogPosition = NinjaLogPosition()) -> Optional[list[NinjaLogEntry]]:
+    """
+    Read the entries of .ninja_log (format v5/v6) appended after position.
+
+    Returns None when ninja recompacted (rewrote) the log since position: the entries of the build cannot be told
+    apart from older ones.
+    """
+    log_path = build_path / ".ninja_log"
+    try:
+        with log_path.open("rb") as f:
+            stat = os.fstat(f.fileno())
+            if position.size:
+                f.seek(max(position.size - len(position.tail), 0))
+                if stat.st_ino != position.inode or f.read(len(position.tail)) != position.tail:
+                    return None
+            f.seek(position.size)
+            data = f.read().decode("utf-8", errors="replace")
+    except FileNotFoundError:
+        return None if position.size else []
+    entries = []
+    for line in data.splitlines():
+        if line.startswith("#"):
+            continue
+        fields = line.split("\t")
+        if len(fields) != 5:
+            continue
+        start_ms, end_ms, _, output, command_hash = fields
+        entries.append(NinjaLogEntry(start_ms=int(start_ms), end_ms=int(end_ms), output=output,
+                                     command_hash=command_hash))
+    return entries
@@ -0,0 +1,86 @@
+import configparser
+import dataclasses
+from pathlib import Path
+import shutil
+import subprocess
+
+from rec2_bisect.paths import REC2_CONFIG_PATH, REC2_DEPS_ROOT, REC2_DOWNLOAD_ROOT
+
+CCACHE_VERSION = "4.10.2"
+CCACHE_URL = f"https://github.com/ccache/ccache/releases/download/v{CCACHE_VERSION}/ccache-{CCACHE_VERSION}-windows-x86_64.zip"
+# Verified by download_file(); pinned with scripts/pin_digests.py
+CCACHE_SHA256 = None
+CCACHE_ROOT = REC2_DEPS_ROOT / "ccache"
+CCACHE_EXE_PATH = CCACHE_ROOT / "ccache.exe"
+# ccache cannot cache objects compiled with /Zi (shared PDB): embed debug info in the objects instead
+CCACHE_MSVC_CONFIGURE_ARGS = [
+    "-DCMAKE_MSVC_DEBUG_INFORMATION_FORMAT=Embedded",
+    "-DCMAKE_C_FLAGS_DEBUG=/Z7 /Ob0 /Od /RTC1",
+    "-DCMAKE_CXX_FLAGS_DEBUG=/Z7 /Ob0 /Od /RTC1",
+]
+
+
+@dataclasses.dataclass(frozen=True)
+class CcacheConfig:
+    """[ccache] section of config.ini, used by bisect builds and build_history.py sweeps to share one cache"""
+    enabled: bool
+    path: Path
+    max_size: str
+
+    @classmethod
+    def load(cls) -> "CcacheConfig":
+        config = configparser.ConfigParser()
+        if REC2_CONFIG_PATH.is_file():
+            with REC2_CONFIG_PATH.open() as f:
+                config.read_file(f)
+        return cls(
+            enabled=config.getboolean("ccache", "enabled", fallback=False),
+            path=Path(config.get("ccache", "path", fallback="ccache").strip()).resolve(),
+            max_size=config.get("ccache", "max_size", fallback="10G").strip(),
+        )
+
+def ccache_env(path: Path, max_size: str, base_dir: Path) -> dict[str, str]:
+    # Paths below the base directory are hashed relative to it,
+    # so other build trees and worktrees can reuse the same objects.
+    return {
+        "CCACHE_DIR": str(path),
+        "CCACHE_MAXSIZE": max_size,
+        "CCACHE_BASEDIR": str(base_dir),
+        "CCACHE_NOHASHDIR": "1",
+    }
+
+
+def ccache_launcher_args() -> list[str]:
+    if not CCACHE_EXE_PATH.is_file():
+        raise FileNotFoundError("Cannot find ccache (remove the 'deps' folder and run download.bat, or disable ccache in config.ini)")
+    return [
+        f"-DCMAKE_C_COMPILER_LAUNCHER={CCACHE_EXE_PATH}",
+        f"-DCMAKE_CXX_COMPILER_LAUNCHER={CCACHE_EXE_PATH}",
+    ]
+
+
+def download_extract_ccache() -> None:
+    from rec2_bisect.download import download_file, extract_zip
+    download_path = REC2_DOWNLOAD_ROOT / "ccache"
+    download_path.mkdir(parents=True, exist_ok=True)
+
+    shutil.rmtree(CCACHE_ROOT, ignore_errors=True)
+    CCACHE_ROOT.mkdir(parents=True)
+
+    print("[ ] Downloading ccache ...")
+    zip_path = download_path / "ccache.zip"
+    download_file(CCACHE_URL, zip_path, "ccache", sha256=CCACHE_SHA256)
+    print("[x] Downloading ccache finished")
+    print("[ ] Extracting ccache ...")
+    extract_zip(zip_path, CCACHE_ROOT, prefix=f"ccache-{CCACHE_VERSION}-windows-x86_64/")
+    print("[x] Extracting ccache finished")
+
+
+def has_ccache() -> bool:
+    if not CCACHE_EXE_PATH.exists():
+        return False
+    try:
+        subprocess.check_output([str(CCACHE_EXE_PATH), "--version"], text=True)
+        return True
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
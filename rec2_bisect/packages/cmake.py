@@ -1,16 +1,15 @@
-import io
 import os.path
 from pathlib import Path
-import urllib.request
 import shutil
 import subprocess
-import zipfile
 
 from rec2_bisect.paths import REC2_DEPS_ROOT, REC2_DOWNLOAD_ROOT
 
 THIS_PATH = Path(__file__).resolve().parent
 
 CMAKE_URL = "https://github.com/Kitware/CMake/releases/download/v3.31.4/cmake-3.31.4-windows-x86_64.zip"
+# Verified by download_file(); pinned with scripts/pin_digests.py
+CMAKE_SHA256 = None
 CMAKE_ROOT = REC2_DEPS_ROOT / "cmake"
 CMAKE_PATH = CMAKE_ROOT / "bin"
 CMAKE_EXE_PATH = CMAKE_PATH / "cmake.exe"
@@ -20,31 +19,22 @@ CMAKE_ENV = {
 
 
 def download_extract_cmake() -> None:
+    # Only needed for downloading: keeps urllib out of the startup of run.bat
+    from rec2_bisect.download import download_file, extract_zip
     download_path = REC2_DOWNLOAD_ROOT / "cmake"
-    shutil.rmtree(download_path, ignore_errors=True)
-    download_path.mkdir(parents=True)
+    download_path.mkdir(parents=True, exist_ok=True)
 
     shutil.rmtree(CMAKE_ROOT, ignore_errors=True)
     CMAKE_ROOT.mkdir(parents=True)
 
     print("[ ] Downloading CMake ...")
-    with urllib.request.urlopen(CMAKE_URL) as stream:
-        zip_data = stream.read()
     _, filename = CMAKE_URL.rsplit("/", 1)
+    zip_path = download_path / filename
+    download_file(CMAKE_URL, zip_path, "CMake", sha256=CMAKE_SHA256)
     cmake_basename, _ = os.path.splitext(filename)
     print("[x] Downloading CMake finished")
     print("[ ] Extracting CMake ...")
-    with zipfile.ZipFile(io.BytesIO(zip_data)) as zf:
-        lprefix = f"{cmake_basename}/"
-        for arcname in zf.namelist():
-            target_filename = arcname.removeprefix(lprefix)
-            target_path = CMAKE_ROOT / target_filename
-            if arcname.endswith("/"):
-                target_path.mkdir(exist_ok=True)
-                continue
-            data = zf.read(arcname)
-            with open(target_path, "wb") as f:
-                f.write(data)
+    extract_zip(zip_path, CMAKE_ROOT, prefix=f"{cmake_basename}/")
     print("[x] Extracting CMake finished")
 
 
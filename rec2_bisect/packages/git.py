@@ -1,5 +1,4 @@
 from pathlib import Path
-import urllib.request
 import shutil
 import subprocess
 
@@ -8,6 +7,8 @@ from rec2_bisect.paths import REC2_DEPS_ROOT, REC2_DOWNLOAD_ROOT
 THIS_PATH = Path(__file__).resolve().parent
 
 GIT_URL = "https://github.com/git-for-windows/git/releases/download/v2.47.1.windows.2/PortableGit-2.47.1.2-64-bit.7z.exe"
+# Verified by download_file(); pinned with scripts/pin_digests.py
+GIT_SHA256 = None
 GIT_ROOT = REC2_DEPS_ROOT / "git"
 GIT_PATH = GIT_ROOT / "bin"
 GIT_EXE_PATH = GIT_PATH / "git.exe"
@@ -16,19 +17,16 @@ GIT_ENV = {
 }
 
 def download_extract_git() -> None:
+    from rec2_bisect.download import download_file
     download_path = REC2_DOWNLOAD_ROOT / "git"
     installer_exe_path = download_path / "portable-git-installer.exe"
-    shutil.rmtree(download_path, ignore_errors=True)
-    download_path.mkdir(parents=True)
+    download_path.mkdir(parents=True, exist_ok=True)
 
     shutil.rmtree(GIT_ROOT, ignore_errors=True)
     GIT_ROOT.mkdir(parents=True)
 
     print("[ ] Downloading git ...")
-    with urllib.request.urlopen(GIT_URL) as stream:
-        exe_data = stream.read()
-    with installer_exe_path.open("wb") as f:
-        f.write(exe_data)
+    download_file(GIT_URL, installer_exe_path, "git", sha256=GIT_SHA256)
     print("[x] Downloading git finished")
 
     print("[ ] Extracting git ...")
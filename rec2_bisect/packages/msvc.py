@@ -1,4 +1,6 @@
 import dataclasses
+import hashlib
+import json
 import os
 from pathlib import Path
 import shutil
@@ -9,11 +11,28 @@ import typing
 
 
 from rec2_bisect.paths import REC2_DEPS_ROOT
+from rec2_bisect.trace import span
 from rec2_bisect.util import join_os_environ
 
 MSVC_ROOT = REC2_DEPS_ROOT / "msvc/msvc"
 THIS_PATH = Path(__file__).resolve().parent
 PORTABLE_MSVC_PY = THIS_PATH / "vendored/portable-msvc.py"
+# Outside MSVC_ROOT: writing it must not change the fingerprint of the toolchain directory
+MSVC_TOOLCHAIN_CACHE_ROOT = MSVC_ROOT.parent
+
+
+def msvc_fingerprint(arch: str) -> typing.Optional[dict[str, typing.Any]]:
+    """Identifies the installed toolchain: the setup script and the modification times of the toolchain directories"""
+    try:
+        fingerprint = {
+            "msvc_root": str(MSVC_ROOT),
+            "setup_sha256": hashlib.sha256((MSVC_ROOT / f"setup_{arch}.bat").read_bytes()).hexdigest(),
+        }
+        for subdir in (".", "VC/Tools/MSVC", "Windows Kits/10/bin"):
+            fingerprint[subdir] = (MSVC_ROOT / subdir).stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    return fingerprint
 
 
 @dataclasses.dataclass(frozen=True)
@@ -34,14 +53,62 @@ class MSVCToolchain:
             "LIB": os.path.pathsep.join(str(p) for p in self.lib_path),
         }
 
+    def identity(self) -> dict[str, typing.Any]:
+        """The toolchain independent of where it is installed: the MSVC and Windows SDK versions are part of the paths"""
+        def relative(p: Path) -> str:
+            return p.relative_to(MSVC_ROOT).as_posix() if p.is_relative_to(MSVC_ROOT) else p.name
+        data = {}
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            data[field.name] = [relative(p) for p in value] if isinstance(value, tuple) else relative(value)
+        return data
+
+    def to_json(self) -> dict[str, typing.Any]:
+        data = {}
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            data[field.name] = [str(p) for p in value] if isinstance(value, tuple) else str(value)
+        return data
+
+    @classmethod
+    def from_json(cls, data: dict[str, typing.Any]) -> "MSVCToolchain":
+        return cls(**{
+            k: tuple(Path(p) for p in v) if isinstance(v, list) else Path(v)
+            for k, v in data.items()
+        })
+
     @classmethod
     def create(cls, arch: str) -> typing.Optional["MSVCToolchain"]:
+        """Toolchain of setup_{arch}.bat, served from a cache file while the toolchain fingerprint is unchanged"""
+        fingerprint = msvc_fingerprint(arch)
+        if fingerprint is None:
+            return None
+        cache_path = MSVC_TOOLCHAIN_CACHE_ROOT / f"toolchain_{arch}.json"
+        try:
+            cached = json.loads(cache_path.read_text())
+            if cached["fingerprint"] == fingerprint:
+                toolchain = cls.from_json(cached["toolchain"])
+                if toolchain.cl_exe.is_file():
+                    return toolchain
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+        toolchain = cls.capture(arch)
+        if toolchain is not None:
+            tmp_path = cache_path.with_suffix(".tmp")
+            tmp_path.write_text(json.dumps({"fingerprint": fingerprint, "toolchain": toolchain.to_json()}, indent=2))
+            os.replace(tmp_path, cache_path)
+        return toolchain
+
+    @classmethod
+    def capture(cls, arch: str) -> typing.Optional["MSVCToolchain"]:
+        """Run setup_{arch}.bat and capture the resulting environment"""
         msvc_setup_bat = MSVC_ROOT / f"setup_{arch}.bat"
         if not msvc_setup_bat.exists():
             return None
         try:
-            output_env = subprocess.check_output([
-                "cmd", "/c", f"setup_{arch}.bat && set"], cwd=MSVC_ROOT, text=True, stdin=subprocess.DEVNULL)
+            with span("MSVC environment capture", "subprocess", arch=arch):
+                output_env = subprocess.check_output([
+                    "cmd", "/c", f"setup_{arch}.bat && set"], cwd=MSVC_ROOT, text=True, stdin=subprocess.DEVNULL)
         except subprocess.CalledProcessError:
             return None
         msvc_env_paths = {}
@@ -104,7 +171,8 @@ def has_msvc(arch: str) -> bool:
         "/MT", f"/Fo{selftest_obj}"
     ]
     try:
-        subprocess.check_call(compile_args, text=True, cwd=temp_path, env=msvc_env)
+        with span("MSVC self-test compile", "subprocess"):
+            subprocess.check_call(compile_args, text=True, cwd=temp_path, env=msvc_env)
     except (subprocess.CalledProcessError, FileNotFoundError):
         print("Test compilation failed")
         return False
@@ -117,7 +185,8 @@ def has_msvc(arch: str) -> bool:
         f"/PDB:{selftest_pdb}", "user32.lib"
     ]
     try:
-        subprocess.check_call(link_args, text=True, cwd=temp_path, env=msvc_env)
+        with span("MSVC self-test link", "subprocess"):
+            subprocess.check_call(link_args, text=True, cwd=temp_path, env=msvc_env)
     except (subprocess.CalledProcessError, FileNotFoundError):
         print("Test linking failed")
         return False
@@ -125,7 +194,8 @@ def has_msvc(arch: str) -> bool:
         return False
     dumpbin_args = [msvc_toolchain.dumpbin_exe, "/IMPORTS", str(selftest_exe)]
     try:
-        subprocess.run(dumpbin_args, capture_output=True, text=True, cwd=temp_path, env=msvc_env)
+        with span("MSVC self-test dumpbin", "subprocess"):
+            subprocess.run(dumpbin_args, capture_output=True, text=True, cwd=temp_path, env=msvc_env)
     except (subprocess.CalledProcessError, FileNotFoundError):
         print("Test dumpbin failed")
         return False
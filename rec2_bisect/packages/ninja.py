@@ -1,6 +1,4 @@
-import io
 from pathlib import Path
-import urllib.request
 import shutil
 import subprocess
 import zipfile
@@ -11,6 +9,8 @@ THIS_PATH = Path(__file__).resolve().parent
 
 
 NINJA_URL = "https://github.com/ninja-build/ninja/releases/download/v1.12.1/ninja-win.zip"
+# Verified by download_file(); pinned with scripts/pin_digests.py
+NINJA_SHA256 = None
 NINJA_ROOT = REC2_DEPS_ROOT / "ninja"
 NINJA_PATH = NINJA_ROOT
 NINJA_EXE_PATH = NINJA_ROOT / "ninja.exe"
@@ -20,19 +20,19 @@ NINJA_ENV = {
 
 
 def download_extract_ninja() -> None:
+    from rec2_bisect.download import download_file
     download_path = REC2_DOWNLOAD_ROOT / "ninja"
-    shutil.rmtree(download_path, ignore_errors=True)
-    download_path.mkdir(parents=True)
+    download_path.mkdir(parents=True, exist_ok=True)
 
     shutil.rmtree(NINJA_ROOT, ignore_errors=True)
     NINJA_ROOT.mkdir(parents=True)
 
     print("[ ] Downloading ninja ...")
-    with urllib.request.urlopen(NINJA_URL) as stream:
-        zip_data = stream.read()
+    zip_path = download_path / "ninja-win.zip"
+    download_file(NINJA_URL, zip_path, "ninja", sha256=NINJA_SHA256)
     print("[x] Downloading ninja finished")
     print("[ ] Extracting ninja ...")
-    with zipfile.ZipFile(io.BytesIO(zip_data)) as zf:
+    with zipfile.ZipFile(zip_path) as zf:
         zf.extract("ninja.exe", NINJA_ROOT)
     print("[x] Extracting ninja finished")
 
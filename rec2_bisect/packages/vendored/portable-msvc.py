@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import io
 import os
 import sys
 import stat
@@ -10,7 +9,10 @@ import hashlib
 import zipfile
 import tempfile
 import argparse
+import time
+import threading
 import subprocess
+import concurrent.futures
 import urllib.error
 import urllib.request
 from pathlib import Path
@@ -36,37 +38,152 @@ def download(url):
     return res.read()
 
 total_download = 0
+total_download_lock = threading.Lock()
+
+DOWNLOAD_JOBS = 8
+EXTRACT_JOBS = os.cpu_count() or 4
+
+# Windows Installer runs one installation at a time, parallel msiexec processes would only wait for each other
+INSTALL_JOBS = 1
+ERROR_INSTALL_ALREADY_RUNNING = 1618
+INSTALL_RETRY_SECONDS = 1
+INSTALL_RETRIES = 600
+
+# paths (relative to OUTPUT) of all files unpacked from vsix and msi payloads, used by the cleanup passes
+extracted = set()
+extracted_lock = threading.Lock()
+
+def read_verified(fpath):
+  # sidecar record of an earlier verified download: trusted while size and mtime still match
+  try:
+    record = json.loads(fpath.with_name(fpath.name + ".sha256.json").read_text())
+  except (FileNotFoundError, ValueError):
+    return None
+  st = fpath.stat()
+  if record.get("size") != st.st_size or record.get("mtime_ns") != st.st_mtime_ns:
+    return None
+  return record.get("sha256")
+
+def write_verified(fpath, digest):
+  st = fpath.stat()
+  record = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+  fpath.with_name(fpath.name + ".sha256.json").write_text(json.dumps(record))
+
+def file_sha256(fpath):
+  h = hashlib.sha256()
+  with fpath.open("rb") as f:
+    while True:
+      block = f.read(1<<20)
+      if not block:
+        return h.hexdigest()
+      h.update(block)
 
 def download_progress(url, check, filename):
   fpath = DOWNLOADS / filename
+  check = check.lower()
   if fpath.exists():
-    data = fpath.read_bytes()
-    if hashlib.sha256(data).hexdigest() == check.lower():
-      print(f"\r{filename} ... OK")
-      return data
-
+    digest = read_verified(fpath)
+    if digest is None:
+      digest = file_sha256(fpath)
+      if digest == check:
+        write_verified(fpath, digest)
+    if digest == check:
+      print(f"{filename} ... OK")
+      return fpath
+
+  # hash while streaming to disk, the payload is never kept in memory
   global total_download
-  with fpath.open("wb") as f:
-    data = io.BytesIO()
+  part = fpath.with_name(fpath.name + ".part")
+  h = hashlib.sha256()
+  size = 0
+  with part.open("wb") as f:
     with urllib.request.urlopen(url, context=ssl_context) as res:
-      total = int(res.headers["Content-Length"])
-      size = 0
       while True:
         block = res.read(1<<20)
         if not block:
           break
         f.write(block)
-        data.write(block)
+        h.update(block)
         size += len(block)
-        perc = size * 100 // total
-        print(f"\r{filename} ... {perc}%", end="")
-    print()
-    data = data.getvalue()
-    digest = hashlib.sha256(data).hexdigest()
-    if check.lower() != digest:
-      sys.exit(f"Hash mismatch for f{pkg}")
-    total_download += len(data)
-    return data
+  digest = h.hexdigest()
+  if check != digest:
+    part.unlink()
+    sys.exit(f"Hash mismatch for {filename}")
+  part.replace(fpath)
+  write_verified(fpath, digest)
+  with total_download_lock:
+    total_download += size
+  print(f"{filename} ... {size>>20} MB")
+  return fpath
+
+def download_all(payloads, process=None):
+  # payloads: list of (url, sha256, filename), downloaded by a bounded pool of workers
+  # process is started for every payload as soon as it is downloaded and verified
+  with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as downloads, \
+       concurrent.futures.ThreadPoolExecutor(max_workers=EXTRACT_JOBS) as workers:
+    futures = [downloads.submit(download_progress, url, check, filename) for url, check, filename in payloads]
+    if process is not None:
+      processed = [workers.submit(process, future.result()) for future in concurrent.futures.as_completed(futures)]
+      for future in processed:
+        future.result()
+    return [future.result() for future in futures]
+
+def add_extracted(names):
+  with extracted_lock:
+    extracted.update(names)
+
+def indexed(*prefix):
+  return sorted(name for name in extracted if name.parts[:len(prefix)] == prefix)
+
+def claim_extracted(name):
+  # several vsix packages contain the same files: only the first worker to claim a path writes it
+  with extracted_lock:
+    if name in extracted:
+      return False
+    extracted.add(name)
+    return True
+
+def extract_vsix(vsix):
+  with zipfile.ZipFile(vsix) as z:
+    for info in z.infolist():
+      if info.is_dir() or not info.filename.startswith("Contents/"):
+        continue
+      name = Path(info.filename).relative_to("Contents")
+      if not claim_extracted(name):
+        continue
+      out = OUTPUT / name
+      out.parent.mkdir(parents=True, exist_ok=True)
+      with z.open(info) as src, out.open("wb") as dst:
+        shutil.copyfileobj(src, dst, 1<<20)
+
+def install_msi(msi, cabs, staging):
+  # administrative install into a private staging folder, merged into OUTPUT afterwards
+  for cab in cabs:
+    cab.result()
+  for retry in range(INSTALL_RETRIES + 1):
+    res = subprocess.run(f'msiexec.exe /a "{msi}" /quiet /qn TARGETDIR="{staging.resolve()}"')
+    if res.returncode != ERROR_INSTALL_ALREADY_RUNNING:
+      break
+    if retry == 0:
+      print(f"{msi.name} ... waiting for another Windows Installer installation to finish")
+    time.sleep(INSTALL_RETRY_SECONDS)
+  else:
+    sys.exit(f"Cannot install {msi.name}: another Windows Installer installation is still running after "
+             f"{INSTALL_RETRIES * INSTALL_RETRY_SECONDS} seconds (e.g. Windows Update), try again when it is done")
+  res.check_returncode()
+  names = []
+  for root, _, files in os.walk(staging):
+    for f in files:
+      src = Path(root) / f
+      name = src.relative_to(staging)
+      if name == Path(msi.name):
+        continue
+      out = OUTPUT / name
+      out.parent.mkdir(parents=True, exist_ok=True)
+      os.replace(src, out)
+      names.append(name)
+  add_extracted(names)
+  print(f"{msi.name} ... unpacked")
 
 # super crappy msi format parser just to find required .cab files
 def get_msi_cabs(msi):
@@ -91,6 +208,7 @@ ap.add_argument("--sdk-version", help="Get specific Windows SDK version")
 ap.add_argument("--preview", action="store_true", help="Use preview channel for Preview versions")
 ap.add_argument("--target", default=DEFAULT_TARGET, help=f"Target architectures, comma separated ({','.join(ALL_TARGETS)})")
 ap.add_argument("--host", default=DEFAULT_HOST, help=f"Host architecture", choices=ALL_HOSTS)
+ap.add_argument("--jobs", type=int, default=DOWNLOAD_JOBS, help=f"Number of concurrent downloads (default {DOWNLOAD_JOBS})")
 args = ap.parse_args()
 
 host = args.host
@@ -220,20 +338,16 @@ for target in targets:
     redist_pkg = first(redist["dependencies"], lambda dep: dep.endswith(".base")).lower()
   msvc_packages += [redist_pkg]
 
+msvc_payloads = []
 for pkg in sorted(msvc_packages):
   if pkg not in packages:
-    print(f"\r{pkg} ... !!! MISSING !!!")
+    print(f"{pkg} ... !!! MISSING !!!")
     continue
   p = first(packages[pkg], lambda p: p.get("language") in (None, "en-US"))
   for payload in p["payloads"]:
-    filename = payload["fileName"]
-    download_progress(payload["url"], payload["sha256"], filename)
-    with zipfile.ZipFile(DOWNLOADS / filename) as z:
-      for name in z.namelist():
-        if name.startswith("Contents/"):
-          out = OUTPUT / Path(name).relative_to("Contents")
-          out.parent.mkdir(parents=True, exist_ok=True)
-          out.write_bytes(z.read(name))
+    msvc_payloads.append((payload["url"], payload["sha256"], payload["fileName"]))
+
+download_all(msvc_payloads, extract_vsix)
 
 
 ### download Windows SDK
@@ -260,35 +374,36 @@ with tempfile.TemporaryDirectory(dir=DOWNLOADS) as d:
   sdk_pkg = packages[sdk_pid][0]
   sdk_pkg = packages[first(sdk_pkg["dependencies"]).lower()][0]
 
-  msi = []
-  cabs = []
-
   # download msi files
+  msi_payloads = []
   for pkg in sorted(sdk_packages):
     payload = first(sdk_pkg["payloads"], lambda p: p["fileName"] == f"Installers\\{pkg}")
     if payload is None:
       continue
-    msi.append(DOWNLOADS / pkg)
-    data = download_progress(payload["url"], payload["sha256"], pkg)
-    cabs += list(get_msi_cabs(data))
-
-  # download .cab files
-  for pkg in cabs:
-    payload = first(sdk_pkg["payloads"], lambda p: p["fileName"] == f"Installers\\{pkg}")
-    download_progress(payload["url"], payload["sha256"], pkg)
-
-  print("Unpacking msi files...")
-
-  # run msi installers
-  for m in msi:
-    subprocess.check_call(f'msiexec.exe /a "{m}" /quiet /qn TARGETDIR="{OUTPUT.resolve()}"')
-    (OUTPUT / m.name).unlink()
+    msi_payloads.append((payload["url"], payload["sha256"], pkg))
+  msi = download_all(msi_payloads)
+
+  # download .cab files, every msi installer runs as soon as its own .cab files are there
+  with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as downloads, \
+       concurrent.futures.ThreadPoolExecutor(max_workers=INSTALL_JOBS) as installs:
+    cab_futures = {}
+    installed = []
+    for m in msi:
+      cabs = []
+      for pkg in get_msi_cabs(m.read_bytes()):
+        if pkg not in cab_futures:
+          payload = first(sdk_pkg["payloads"], lambda p: p["fileName"] == f"Installers\\{pkg}")
+          cab_futures[pkg] = downloads.submit(download_progress, payload["url"], payload["sha256"], pkg)
+        cabs.append(cab_futures[pkg])
+      installed.append(installs.submit(install_msi, m, cabs, dst / m.stem))
+    for future in installed:
+      future.result()
 
 
 ### versions
 
-msvcv = first((OUTPUT / "VC/Tools/MSVC").glob("*")).name
-sdkv = first((OUTPUT / "Windows Kits/10/bin").glob("*")).name
+msvcv = first(indexed("VC", "Tools", "MSVC")).parts[3]
+sdkv = first(indexed("Windows Kits", "10", "bin"), lambda name: len(name.parts) > 4).parts[3]
 
 
 # place debug CRT runtime files into MSVC bin folder (not what real Visual Studio installer does... but is reasonable)
@@ -296,13 +411,14 @@ sdkv = first((OUTPUT / "Windows Kits/10/bin").glob("*")).name
 
 redist = OUTPUT / "VC/Redist"
 
-if redist.exists():
-  redistv = first((redist / "MSVC").glob("*")).name
-  src = redist / "MSVC" / redistv / "debug_nonredist"
+if indexed("VC", "Redist"):
+  redistv = first(indexed("VC", "Redist", "MSVC")).parts[3]
   for target in targets:
-    for f in (src / target).glob("**/*.dll"):
+    for name in indexed("VC", "Redist", "MSVC", redistv, "debug_nonredist", target):
+      if name.suffix.lower() != ".dll":
+        continue
       dst = OUTPUT / "VC/Tools/MSVC" / msvcv / f"bin/Host{host}" / target
-      f.replace(dst / f.name)
+      (OUTPUT / name).replace(dst / name.name)
 
   shutil.rmtree(redist)
 
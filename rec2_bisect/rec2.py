@@ -1,24 +1,40 @@
 import configparser
+import datetime
+import functools
 import hashlib
+import json
 import os
 from pathlib import Path
 import shlex
 import shutil
 import subprocess
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
-from .git_util import git_hash
-from .util import join_os_environ
+from . import trace
+from .artifact_cache import ArtifactCache
+from .build_results import BuildResults
+from .git_util import git_hash, git_local_changes, read_git_head
+from .ninja_log import ninja_log_position, read_ninja_log
+from .util import format_size, join_os_environ, parse_size
+from .source_key import DEFAULT_IGNORE_PATTERNS, SourceKeys
+from .packages.ccache import CCACHE_EXE_PATH, CCACHE_MSVC_CONFIGURE_ARGS, CcacheConfig, ccache_env, ccache_launcher_args
 from .packages.git import GIT_ENV
 from .packages.cmake import CMAKE_ENV
 from .packages.msvc import MSVCToolchain
 from .packages.ninja import NINJA_ENV
 
+if TYPE_CHECKING:
+    from .remote_cache import RemoteCache
+
 REC2_BISECT_ROOT = Path(__file__).resolve().parent
 
 REC2_DLL_NAME = "rec2.dll"
 REC2_PDB_NAME = "rec2.pdb"
 REC2_INJECTOR_EXE_NAME = "rec2-injector.exe"
+# .ninja_log entries of every build, in the cache directory (scripts/ninja_report.py --what rec2)
+REC2_BUILDS_DB_NAME = "builds.sqlite"
+# Fingerprint of the inputs of the last successful cmake configure, in the build directory
+REC2_CONFIGURE_FINGERPRINT_NAME = "rec2_configure.json"
 
 
 def is_rec2_source_path(p: Path) -> bool:
@@ -31,6 +47,25 @@ def is_rec2_source_path(p: Path) -> bool:
     return True
 
 
+def cmake_inputs_digest(source_path: Path, exclude: Path) -> str:
+    """
+    Digest of the paths of all files of the source tree, and the contents of all CMakeLists.txt and *.cmake files.
+
+    The file listing is included because file(GLOB) without CONFIGURE_DEPENDS only sees added or removed sources
+    when cmake configure runs again.
+    """
+    h = hashlib.sha256()
+    exclude = exclude.resolve()
+    for root, dirs, files in os.walk(source_path):
+        dirs[:] = sorted(d for d in dirs if d != ".git" and (Path(root) / d).resolve() != exclude)
+        for name in sorted(files):
+            path = Path(root) / name
+            h.update(path.relative_to(source_path).as_posix().encode() + b"\0")
+            if name == "CMakeLists.txt" or name.endswith(".cmake"):
+                h.update(hashlib.sha256(path.read_bytes()).digest())
+    return h.hexdigest()
+
+
 def is_carma2_game_path(p: Path) -> bool:
     c2_hw_exe = p / "CARMA2_HW.EXE"
     if not c2_hw_exe.is_file():
@@ -50,14 +85,56 @@ class REC2:
                  cache_path: Path,
                  game_path: Path,
                  run_args: list[str],
-                 windbg_path: Optional[Path]):
+                 windbg_path: Optional[Path],
+                 ccache_path: Optional[Path] = None,
+                 ccache_max_size: str = "10G",
+                 cache_max_size: int = 20 << 30,
+                 cache_ignore: tuple[str, ...] = DEFAULT_IGNORE_PATTERNS,
+                 remote_cache_url: Optional[str] = None,
+                 remote_cache_upload: bool = True,
+                 remote_cache_jobs: int = 4,
+                 reconfigure: bool = False):
         self.source_path = source_path
         self.build_path = build_path
         self.cache_path = cache_path
+        self.artifact_cache = ArtifactCache(cache_path, max_size=cache_max_size)
+        self.source_keys = SourceKeys(source_path, ignore_patterns=cache_ignore)
         self.game_path = game_path
         self.run_args = run_args
         self.windbg_path = windbg_path
-        self.msvc_toolchain = MSVCToolchain.create(arch="x86")
+        self.ccache_path = ccache_path
+        self.ccache_max_size = ccache_max_size
+        self.remote_cache_url = remote_cache_url
+        self.remote_cache_upload = remote_cache_upload
+        self.remote_cache_jobs = remote_cache_jobs
+        self.reconfigure = reconfigure
+
+    @functools.cached_property
+    def msvc_toolchain(self) -> MSVCToolchain:
+        # Only resolved when something is built or run with the build environment
+        with trace.span("MSVC toolchain"):
+            return MSVCToolchain.create(arch="x86")
+
+    @functools.cached_property
+    def remote_cache(self) -> Optional["RemoteCache"]:
+        if not self.remote_cache_url:
+            return None
+        # Imported on demand: running a cached build does not need urllib
+        from .remote_cache import RemoteCache
+        return RemoteCache.open(self.remote_cache_url, self.artifact_cache, jobs=self.remote_cache_jobs)
+
+    @functools.cached_property
+    def toolchain_key(self) -> str:
+        """Identifies the compiler and the flags that affect the artifacts: the remote cache is shared per toolchain key"""
+        identity = {"msvc": self.msvc_toolchain.identity(), "ccache": bool(self.ccache_path)}
+        return "msvc-" + hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()[:16]
+
+    @property
+    def ccache_env(self) -> dict[str, str]:
+        if not self.ccache_path:
+            return {}
+        # The cache directory and size are shared with build_history.py --ccache sweeps
+        return ccache_env(self.ccache_path, self.ccache_max_size, self.source_path.parent)
 
     @property
     def run_env(self) -> dict[str, str]:
@@ -66,19 +143,81 @@ class REC2:
             GIT_ENV,
             NINJA_ENV,
             self.msvc_toolchain.env,
+            self.ccache_env,
         )
 
+    @property
+    def ccache_configure_args(self) -> list[str]:
+        if not self.ccache_path:
+            return []
+        return ccache_launcher_args() + CCACHE_MSVC_CONFIGURE_ARGS
+
+    def ccache_stats(self) -> None:
+        if not self.ccache_path:
+            print("ccache is disabled (enable it in config.ini)")
+            return
+        with trace.span("ccache --show-stats", "subprocess"):
+            subprocess.check_call([str(CCACHE_EXE_PATH), "--show-stats"], env=self.run_env)
+
+    def configure_fingerprint(self, configure_cmd: list[str]) -> str:
+        """Identifies the inputs of cmake configure: its arguments, the toolchain environment and the source files"""
+        inputs = {
+            "configure": configure_cmd,
+            "env": [CMAKE_ENV, GIT_ENV, NINJA_ENV, self.msvc_toolchain.env, self.ccache_env],
+            "cmake_inputs": cmake_inputs_digest(self.source_path, exclude=self.build_path),
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def configure(self, configure_cmd: list[str]) -> None:
+        """
+        Run cmake configure, unless its inputs did not change since the last configure of the build directory.
+
+        When it is skipped, the regeneration rule of build.ninja still re-runs cmake during the build when needed.
+        """
+        fingerprint_path = self.build_path / REC2_CONFIGURE_FINGERPRINT_NAME
+        with trace.span("configure fingerprint", "cmake"):
+            fingerprint = self.configure_fingerprint(configure_cmd)
+        try:
+            previous = json.loads(fingerprint_path.read_text()).get("fingerprint")
+        except (FileNotFoundError, ValueError, AttributeError):
+            previous = None
+        if not self.reconfigure and previous == fingerprint and (self.build_path / "build.ninja").is_file():
+            print("Configure inputs did not change: skipping cmake configure")
+            return
+        # Removed first: an interrupted or failed configure must run again
+        fingerprint_path.unlink(missing_ok=True)
+        print("Configuring rec2:", configure_cmd)
+        with trace.span("cmake configure", "subprocess"):
+            subprocess.check_call(configure_cmd, env=self.run_env)
+        fingerprint_path.write_text(json.dumps({"fingerprint": fingerprint}))
+        # --reconfigure applies to the first build: later builds of this process trust the new fingerprint
+        self.reconfigure = False
+
+    def check_build_outputs(self, outputs: list[Path]) -> None:
+        """
+        Raise unless ninja considers every output an up to date output of the current build graph.
+
+        A file left behind by an earlier build, that the graph of this commit no longer produces (or writes
+        elsewhere), is an unknown target or out of date, and is never stored under the key of this commit.
+        """
+        targets = [output.relative_to(self.build_path).as_posix() for output in outputs]
+        with trace.span("check build outputs", "subprocess"):
+            result = subprocess.run(["ninja", "-C", str(self.build_path), "-n"] + targets,
+                                    capture_output=True, text=True, env=self.run_env)
+        missing = [output.name for output in outputs if not output.is_file()]
+        if result.returncode != 0 or "no work to do" not in result.stdout or missing:
+            details = (result.stderr or result.stdout).strip().splitlines()
+            raise FileNotFoundError(f"Building rec2 did not produce {', '.join(output.name for output in outputs)}"
+                                    + (f" ({details[-1]})" if details else ""))
+
+    @trace.traced("build")
     def build(self):
         build_bin_path = self.build_path / "bin"
         build_dll_path = build_bin_path / REC2_DLL_NAME
         build_pdb_path = build_bin_path / REC2_PDB_NAME
         build_injector_path = build_bin_path / REC2_INJECTOR_EXE_NAME
-        build_dll_path.unlink(missing_ok=True)
-        build_pdb_path.unlink(missing_ok=True)
-        build_injector_path.unlink(missing_ok=True)
-
-        assert not build_dll_path.is_file()
-        assert not build_injector_path.is_file()
+        # The outputs of the previous build are kept: ninja only relinks (and rewrites the PDB) when an input changed.
+        # check_build_outputs() makes sure they are outputs of this commit's build graph.
 
         hash_start = git_hash(self.source_path)
         configure_cmd = [
@@ -92,69 +231,191 @@ class REC2:
             "-DCMAKE_C_COMPILER=cl.exe",
             "-DCMAKE_CXX_COMPILER=cl.exe",
             "-GNinja",
-        ]
+        ] + self.ccache_configure_args
         build_cmd = [
             "cmake",
             "--build", str(self.build_path),
             "--target", "rec2", "rec2-injector",
             # "--verbose",
         ]
-        print("Configuring rec2:", configure_cmd)
-        subprocess.check_call(configure_cmd, env=self.run_env)
+        log_position = ninja_log_position(self.build_path)
+        self.configure(configure_cmd)
         print("Building rec2:", build_cmd)
-        subprocess.check_call(build_cmd, env=self.run_env)
+        with trace.span("cmake build", "subprocess"):
+            subprocess.check_call(build_cmd, env=self.run_env)
         hash_end = git_hash(self.source_path)
         if hash_start != hash_end:
             raise ValueError("commit hash changed while building rec2")
-        build_cache_path = self.cache_path / hash_end
-        shutil.rmtree(build_cache_path, ignore_errors=True)
-        build_cache_path.mkdir(parents=True)
-        rec2_cache_dll_path = build_cache_path / REC2_DLL_NAME
-        rec2_cache_pdb_path = build_cache_path / REC2_PDB_NAME
-        rec2_cache_injector_path = build_cache_path / REC2_INJECTOR_EXE_NAME
-        print(f"Copying {REC2_DLL_NAME}, {REC2_PDB_NAME} and {REC2_INJECTOR_EXE_NAME} to {rec2_cache_dll_path}")
-        shutil.copyfile(src=build_dll_path, dst=rec2_cache_dll_path)
+        self.check_build_outputs([build_dll_path, build_injector_path])
+        artifacts = [build_dll_path, build_injector_path]
         if build_pdb_path.is_file():
-            shutil.copyfile(src=build_pdb_path, dst=rec2_cache_pdb_path)
-        shutil.copyfile(src=build_injector_path, dst=rec2_cache_injector_path)
+            artifacts.append(build_pdb_path)
+        key = self.cache_key(hash_end)
+        print(f"Storing {', '.join(p.name for p in artifacts)} of {hash_end} in {self.cache_path}")
+        with trace.span("store artifacts", "cache"):
+            self.artifact_cache.store(key, artifacts, commit=hash_end)
+        if self.remote_cache and self.remote_cache_upload:
+            # The key only covers the committed tree: a build of local edits must not reach other machines
+            local_changes = git_local_changes(self.source_path)
+            if local_changes:
+                print(f"[!] Not uploading {hash_end} to the remote cache: the working tree has "
+                      f"{len(local_changes)} local change(s)")
+            else:
+                self.publish_remote_build(hash_end, key)
+        entries = read_ninja_log(self.build_path, log_position)
+        if entries is not None:
+            builds = BuildResults(self.cache_path / REC2_BUILDS_DB_NAME)
+            builds.record_ninja_log(hash_end, "rec2", entries)
+            builds.close()
 
-    def create_run_cmd(self, args: list[str]) -> list[str]:
-        hash_current = git_hash(self.source_path)
-        build_cache_path = self.cache_path / hash_current
+    def cache_key(self, commit: str) -> str:
+        key = self.artifact_cache.resolve_alias(commit)
+        if key is None:
+            with trace.span("source key", "cache", commit=commit):
+                key = self.source_keys.key(commit)
+            self.artifact_cache.set_alias(commit, key)
+        return key
+
+    def migrate_legacy_builds(self) -> None:
+        """Move builds of the old cache layout (cache/<commit>/) into the artifact cache"""
+        for legacy_path in self.artifact_cache.legacy_entries():
+            commit = legacy_path.name
+            artifacts = [legacy_path / name for name in (REC2_DLL_NAME, REC2_INJECTOR_EXE_NAME, REC2_PDB_NAME)
+                         if (legacy_path / name).is_file()]
+            if all((legacy_path / name).is_file() for name in (REC2_DLL_NAME, REC2_INJECTOR_EXE_NAME)):
+                try:
+                    key = self.cache_key(commit)
+                except ValueError:
+                    # The commit is not in the source repository: keep the build under its own key
+                    key = f"commit-{commit}"
+                    self.artifact_cache.set_alias(commit, key)
+                print(f"Moving the build of {commit} into the artifact cache")
+                with trace.span("migrate legacy build", "cache", commit=commit):
+                    self.artifact_cache.store(key, artifacts, commit=commit)
+            else:
+                print(f"Removing the incomplete build of {commit} from the cache")
+            shutil.rmtree(legacy_path, ignore_errors=True)
+
+    def has_cached_build(self, commit: str) -> bool:
+        return self.artifact_cache.contains(self.cache_key(commit), [REC2_DLL_NAME, REC2_INJECTOR_EXE_NAME])
+
+    def fetch_remote_build(self, commit: str) -> bool:
+        """Download the build of commit from the remote cache into the local cache. Failures only cost the download."""
+        if not self.remote_cache:
+            return False
+        print(f"[ ] Looking up {commit} in the remote cache {self.remote_cache.store} ...")
+        try:
+            with trace.span("remote cache fetch", "cache", commit=commit):
+                found = self.remote_cache.fetch(self.toolchain_key, self.cache_key(commit),
+                                                [REC2_DLL_NAME, REC2_INJECTOR_EXE_NAME])
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[!] Downloading {commit} from the remote cache failed: {e}")
+            return False
+        if found:
+            print(f"[x] Downloaded {commit} from the remote cache")
+        else:
+            print(f"[x] {commit} is not in the remote cache")
+        return found
+
+    def publish_remote_build(self, commit: str, key: str) -> None:
+        print(f"[ ] Uploading {commit} to the remote cache {self.remote_cache.store} ...")
+        try:
+            with trace.span("remote cache publish", "cache", commit=commit):
+                self.remote_cache.publish(self.toolchain_key, key)
+        except (OSError, KeyError) as e:
+            print(f"[!] Uploading {commit} to the remote cache failed: {e}")
+            return
+        print(f"[x] Uploaded {commit} to the remote cache")
+
+    def _run_cmd(self, build_cache_path: Path, args: list[str]) -> list[str]:
         rec2_cache_dll_path = build_cache_path / REC2_DLL_NAME
         rec2_cache_injector_path = build_cache_path / REC2_INJECTOR_EXE_NAME
-        if not rec2_cache_dll_path.is_file() or not rec2_cache_injector_path.is_file():
-            print(f"No {REC2_DLL_NAME} or {REC2_INJECTOR_EXE_NAME} for {hash_current}. Creating a new build...")
-            self.build()
-        assert rec2_cache_dll_path.is_file()
-        assert rec2_cache_injector_path.is_file()
         return [
             str(rec2_cache_injector_path),
             str(self.game_path / "CARMA2_HW.EXE"),
             "--inject", str(rec2_cache_dll_path),
         ] + ["--"] + args + self.run_args
 
+    def create_run_cmd(self, args: list[str], commit: Optional[str] = None) -> list[str]:
+        hash_current = commit or git_hash(self.source_path)
+        key = self.cache_key(hash_current)
+        if not self.has_cached_build(hash_current) and not self.fetch_remote_build(hash_current):
+            print(f"No {REC2_DLL_NAME} or {REC2_INJECTOR_EXE_NAME} for {hash_current}. Creating a new build...")
+            self.build()
+        else:
+            entry = self.artifact_cache.entry(key)
+            if entry.commit and entry.commit != hash_current:
+                print(f"{hash_current} has the same build inputs as {entry.commit}: reusing its build")
+        with trace.span("materialize artifacts", "cache"):
+            build_cache_path = self.artifact_cache.materialize(key, [REC2_DLL_NAME, REC2_INJECTOR_EXE_NAME])
+        assert build_cache_path
+        return self._run_cmd(build_cache_path, args)
+
+    def cached_run_cmd(self, args: list[str]) -> Optional[list[str]]:
+        """
+        Command running the cached build of HEAD, or None when HEAD has not been built before.
+
+        Nothing is spawned: HEAD is read from the git directory and the cache key from the alias of the commit.
+        """
+        hash_current = read_git_head(self.source_path)
+        if hash_current is None:
+            return None
+        key = self.artifact_cache.resolve_alias(hash_current)
+        if key is None or not self.artifact_cache.contains(key, [REC2_DLL_NAME, REC2_INJECTOR_EXE_NAME]):
+            return None
+        with trace.span("materialize artifacts", "cache"):
+            build_cache_path = self.artifact_cache.materialize(key, [REC2_DLL_NAME, REC2_INJECTOR_EXE_NAME])
+        if build_cache_path is None:
+            return None
+        return self._run_cmd(build_cache_path, args)
+
+    def run_cached(self, args: list[str]) -> bool:
+        """Run the cached build of HEAD without toolchain or dependencies. Returns False when it must be built first."""
+        run_cmd = self.cached_run_cmd(args)
+        if run_cmd is None:
+            return False
+        print("Running rec2:", run_cmd)
+        print("cwd:", self.game_path)
+        with trace.span("run rec2", "subprocess"):
+            subprocess.check_call(run_cmd, cwd=self.game_path)
+        return True
+
     def run(self, args: list[str]):
         run_cmd = self.create_run_cmd(args)
         print("Running rec2:", run_cmd)
         print("cwd:", self.game_path)
-        subprocess.check_call(run_cmd, cwd=self.game_path, env=self.run_env)
+        with trace.span("run rec2", "subprocess"):
+            subprocess.check_call(run_cmd, cwd=self.game_path, env=self.run_env)
 
     def debug(self, args: list[str]):
-        hash_current = git_hash(self.source_path)
-        build_cache_path = self.cache_path / hash_current
         if not self.windbg_path or not self.windbg_path.is_file():
             raise FileNotFoundError("Cannot find WinDbg (install WinDbg, or set windbg.path in config.ini)")
-        run_cmd = [
-            str(self.windbg_path),
-            "-y", str(build_cache_path),
-        ] + self.create_run_cmd(args)
+        hash_current = git_hash(self.source_path)
+        rec2_run_cmd = self.create_run_cmd(args, commit=hash_current)
+        build_cache_path = self.artifact_cache.materialize(self.cache_key(hash_current), [REC2_PDB_NAME])
+        run_cmd = [str(self.windbg_path)]
+        if build_cache_path is not None:
+            run_cmd += ["-y", str(build_cache_path)]
+        else:
+            print(f"[!] The build of {hash_current} has no {REC2_PDB_NAME}, debugging without symbols")
+        run_cmd += rec2_run_cmd
         print("Running rec2:", run_cmd)
         print("cwd:", self.game_path)
-        subprocess.check_call(run_cmd, cwd=self.game_path, env=self.run_env)
+        with trace.span("run rec2 in WinDbg", "subprocess"):
+            subprocess.check_call(run_cmd, cwd=self.game_path, env=self.run_env)
+
+    def cache_info(self) -> None:
+        for entry in self.artifact_cache.entries():
+            last_used = datetime.datetime.fromtimestamp(entry.last_used).isoformat(sep=" ", timespec="seconds")
+            files = ", ".join(f"{f.name} ({format_size(f.size)})" for f in entry.files)
+            print(f"{entry.key}  {entry.commit or '<unknown commit>'}  {last_used}  {files}")
+        stats = self.artifact_cache.stats()
+        print(f"{stats.entries} builds, {stats.blobs} unique files")
+        print(f"Size on disk: {format_size(stats.blobs_size)} of {format_size(stats.max_size)} "
+              f"(uncompressed, without deduplication: {format_size(stats.logical_size)})")
 
     @classmethod
-    def create(cls) -> "REC2":
+    def create(cls, reconfigure: bool = False) -> "REC2":
         config = configparser.ConfigParser()
         config_ini = REC2_BISECT_ROOT / "config.ini"
         with config_ini.open() as f:
@@ -164,6 +425,8 @@ class REC2:
             raise ValueError("Invalid source path. Modify config.ini to point to a rec2 source tree.")
         build_path = Path(config.get("rec2", "build", fallback="build").strip()).resolve()
         cache_path = Path(config.get("rec2", "cache", fallback="cache").strip()).resolve()
+        cache_max_size = parse_size(config.get("rec2", "cache_size", fallback="20G"))
+        cache_ignore = config.get("rec2", "cache_ignore", fallback="").split()
         game_path = Path(config.get("game", "path", fallback="game").strip()).resolve()
         if not is_carma2_game_path(game_path):
             raise ValueError("Invalid game path. Modify config.ini to point to Carmageddon 2 game path.")
@@ -179,6 +442,10 @@ class REC2:
             windbg_path = Path(os.environ.get("LocalAppData", "C:/users/me") + "/Microsoft/WindowsApps/WinDbgX.exe").resolve()
         if not windbg_path.is_file:
             windbg_path = None
+        ccache_config = CcacheConfig.load()
+        remote_cache_url = config.get("remote_cache", "url", fallback="").strip() or None
+        remote_cache_upload = config.getboolean("remote_cache", "upload", fallback=True)
+        remote_cache_jobs = config.getint("remote_cache", "jobs", fallback=4)
 
         return cls(
             source_path=source_path,
@@ -187,4 +454,12 @@ class REC2:
             game_path=game_path,
             run_args=run_args,
             windbg_path=windbg_path,
+            ccache_path=ccache_config.path if ccache_config.enabled else None,
+            ccache_max_size=ccache_config.max_size,
+            cache_max_size=cache_max_size,
+            cache_ignore=tuple(cache_ignore) if cache_ignore else DEFAULT_IGNORE_PATTERNS,
+            remote_cache_url=remote_cache_url,
+            remote_cache_upload=remote_cache_upload,
+            remote_cache_jobs=remote_cache_jobs,
+            reconfigure=reconfigure,
         )
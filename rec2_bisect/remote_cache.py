@@ -0,0 +1,182 @@
+"""
+Artifact cache shared between machines: build nodes and developers publish their builds, others download them.
+
+The remote mirrors the layout of the local ArtifactCache: compressed blobs in blobs/<xx>/<sha256>.<codec>, shared by
+all toolchains, and a manifest per toolchain and source tree key in <toolchain key>/<tree key>.json.
+Blobs are uploaded before the manifest referencing them, so readers never see an entry with missing blobs.
+"""
+import concurrent.futures
+import json
+import os
+from pathlib import Path
+import shutil
+import tempfile
+from typing import Optional
+import urllib.error
+import urllib.request
+
+from .artifact_cache import BLOB_ERRORS, ArtifactCache, ArtifactFile, blob_sha256
+
+REMOTE_CACHE_TIMEOUT = 30
+REMOTE_CACHE_CHUNK_SIZE = 1 << 20
+
+
+class DirectoryStore:
+    """Remote cache in a directory, for example a network share"""
+    def __init__(self, root: Path):
+        self.root = root
+
+    def __str__(self) -> str:
+        return str(self.root)
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            return (self.root / name).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def download(self, name: str, path: Path) -> bool:
+        try:
+            shutil.copyfile(self.root / name, path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def exists(self, name: str) -> bool:
+        return (self.root / name).is_file()
+
+    def upload(self, path: Path, name: str) -> None:
+        target = self.root / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=".tmp-")
+        os.close(fd)
+        try:
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, target)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+
+class HttpStore:
+    """Remote cache on a HTTP server: GET and HEAD to download, PUT to upload (e.g. scripts/cache_server.py)"""
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+
+    def __str__(self) -> str:
+        return self.url
+
+    def _open(self, name: str, method: str = "GET", **kwargs):
+        request = urllib.request.Request(f"{self.url}/{name}", method=method, **kwargs)
+        return urllib.request.urlopen(request, timeout=REMOTE_CACHE_TIMEOUT)
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            with self._open(name) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def download(self, name: str, path: Path) -> bool:
+        try:
+            with self._open(name) as response, path.open("wb") as f:
+                shutil.copyfileobj(response, f, REMOTE_CACHE_CHUNK_SIZE)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+        return True
+
+    def exists(self, name: str) -> bool:
+        try:
+            with self._open(name, method="HEAD"):
+                return True
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+
+    def upload(self, path: Path, name: str) -> None:
+        with path.open("rb") as f:
+            headers = {"Content-Length": str(path.stat().st_size), "Content-Type": "application/octet-stream"}
+            with self._open(name, method="PUT", data=f, headers=headers):
+                pass
+
+
+class RemoteCache:
+    """
+    Downloads builds from, and uploads builds to, a remote store into the local artifact cache.
+
+    Builds are looked up by a toolchain key (the compiler and the build flags) and the source tree key.
+    Downloaded blobs are verified against the SHA-256 digests of the manifest before they enter the local cache.
+    """
+    def __init__(self, store, artifact_cache: ArtifactCache, jobs: int = 4):
+        self.store = store
+        self.artifact_cache = artifact_cache
+        self.jobs = jobs
+
+    @classmethod
+    def open(cls, url: str, artifact_cache: ArtifactCache, jobs: int = 4) -> "RemoteCache":
+        """url is a http(s) URL or a directory"""
+        if url.startswith(("http://", "https://")):
+            store = HttpStore(url)
+        else:
+            store = DirectoryStore(Path(url))
+        return cls(store, artifact_cache, jobs=jobs)
+
+    def _blob_name(self, artifact: ArtifactFile) -> str:
+        blob_path = self.artifact_cache.blob_path(artifact.sha256, artifact.codec)
+        return blob_path.relative_to(self.artifact_cache.root).as_posix()
+
+    def _fetch_blob(self, artifact: ArtifactFile) -> None:
+        blob_path = self.artifact_cache.blob_path(artifact.sha256, artifact.codec)
+        if blob_path.is_file():
+            return
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=blob_path.parent, prefix=".tmp-")
+        os.close(fd)
+        try:
+            if not self.store.download(self._blob_name(artifact), Path(tmp)):
+                raise FileNotFoundError(f"{artifact.name} ({artifact.sha256}) is missing from {self.store}")
+            try:
+                digest = blob_sha256(Path(tmp), artifact.codec)
+            except BLOB_ERRORS as e:
+                raise ValueError(f"{artifact.name} from {self.store} is damaged: {e}") from e
+            if digest != artifact.sha256:
+                raise ValueError(f"SHA-256 mismatch for {artifact.name}: expected {artifact.sha256}, got {digest}")
+            os.replace(tmp, blob_path)
+        finally:
+            Path(tmp).unlink(missing_ok=True)
+
+    def fetch(self, toolchain_key: str, key: str, names: list[str]) -> bool:
+        """Download the build of key into the local cache. Returns False when the remote does not have it."""
+        data = self.store.read(f"{toolchain_key}/{key}.json")
+        if data is None:
+            return False
+        manifest = json.loads(data)
+        artifacts = [ArtifactFile(name=name, sha256=f["sha256"], size=f["size"], codec=f.get("codec", "none"))
+                     for name, f in manifest["files"].items()]
+        if not set(names) <= {artifact.name for artifact in artifacts}:
+            return False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for future in [executor.submit(self._fetch_blob, artifact) for artifact in artifacts]:
+                future.result()
+        self.artifact_cache.add_entry(key, artifacts, commit=manifest.get("commit"))
+        return True
+
+    def _publish_blob(self, artifact: ArtifactFile) -> None:
+        name = self._blob_name(artifact)
+        if not self.store.exists(name):
+            self.store.upload(self.artifact_cache.blob_path(artifact.sha256, artifact.codec), name)
+
+    def publish(self, toolchain_key: str, key: str) -> None:
+        """Upload the build of key from the local cache"""
+        entry = self.artifact_cache.entry(key)
+        if entry is None:
+            raise KeyError(f"{key} is not in the local artifact cache")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            for future in [executor.submit(self._publish_blob, artifact) for artifact in entry.files]:
+                future.result()
+        self.store.upload(self.artifact_cache.manifest_path(key), f"{toolchain_key}/{key}.json")
@@ -0,0 +1,53 @@
+import fnmatch
+import hashlib
+from pathlib import Path
+
+from .git_util import GitSession, git_session
+
+# Paths that do not influence the build of rec2.dll and rec2-injector.exe
+DEFAULT_IGNORE_PATTERNS = (
+    ".github",
+    ".gitignore",
+    ".gitattributes",
+    ".clang-format",
+    ".editorconfig",
+    "docs",
+    "LICENSE*",
+    "README*",
+    "*.md",
+)
+
+
+class SourceKeys:
+    """
+    Cache keys derived from the build-relevant files of a commit.
+
+    The key hashes the git tree of the commit without the paths matching the ignore patterns (at any depth).
+    Submodules contribute their commit hash. Commits that only touch ignored paths share a key with their parent.
+    """
+    def __init__(self, path: Path, ignore_patterns: tuple[str, ...] = DEFAULT_IGNORE_PATTERNS):
+        self.session: GitSession = git_session(path)
+        self.ignore_patterns = ignore_patterns
+        self._tree_keys: dict[str, str] = {}
+        self._commit_keys: dict[str, str] = {}
+
+    def _ignored(self, name: str) -> bool:
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self.ignore_patterns)
+
+    def _tree_key(self, tree_hash: str) -> str:
+        key = self._tree_keys.get(tree_hash)
+        if key is None:
+            h = hashlib.sha256()
+            for entry in self.session.read_tree(tree_hash):
+                if self._ignored(entry.name):
+                    continue
+                entry_hash = self._tree_key(entry.hash) if entry.is_tree else entry.hash
+                h.update(f"{entry.mode} {entry.name} {entry_hash}\n".encode("utf-8", errors="surrogateescape"))
+            key = self._tree_keys[tree_hash] = h.hexdigest()
+        return key
+
+    def key(self, commit: str) -> str:
+        key = self._commit_keys.get(commit)
+        if key is None:
+            key = self._commit_keys[commit] = "tree-" + self._tree_key(self.session.read_commit(commit).tree)
+        return key
@@ -0,0 +1,98 @@
+"""
+Opt-in tracing of phases and subprocesses, written as a Chrome trace (chrome://tracing, https://ui.perfetto.dev).
+
+Tracing is enabled by the REC2_TRACE=<path> environment variable, or by enable() (--trace of rec2_bisect and
+build_history.py). The trace is written when the process exits.
+"""
+import atexit
+import contextlib
+import functools
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Callable, Iterator, Optional, TypeVar
+
+TRACE_ENV = "REC2_TRACE"
+
+F = TypeVar("F", bound=Callable)
+
+_lock = threading.Lock()
+_events: list[dict] = []
+_thread_names: dict[int, str] = {}
+_path: Optional[Path] = None
+_start_ns = time.perf_counter_ns()
+
+
+def enable(path: Path) -> None:
+    global _path
+    if _path is None:
+        atexit.register(write)
+    _path = path
+
+
+def enabled() -> bool:
+    return _path is not None
+
+
+def _now_us() -> float:
+    return (time.perf_counter_ns() - _start_ns) / 1000
+
+
+@contextlib.contextmanager
+def span(name: str, category: str = "rec2", **args) -> Iterator[None]:
+    """Record the duration of the with block as a complete event; args are shown in the trace viewer"""
+    if _path is None:
+        yield
+        return
+    start = _now_us()
+    try:
+        yield
+    finally:
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start,
+            "dur": _now_us() - start,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+        }
+        if args:
+            event["args"] = {k: v if isinstance(v, (int, float, bool)) else str(v) for k, v in args.items()}
+        with _lock:
+            _events.append(event)
+            _thread_names[thread.ident] = thread.name
+
+
+def traced(name: str, category: str = "rec2") -> Callable[[F], F]:
+    """Decorator recording every call of the function as a span"""
+    def decorator(fn: F) -> F:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, category):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write() -> None:
+    if _path is None:
+        return
+    pid = os.getpid()
+    with _lock:
+        events = list(_events)
+        thread_names = dict(_thread_names)
+    metadata = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                for tid, name in thread_names.items()]
+    _path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = _path.with_name(_path.name + ".tmp")
+    tmp_path.write_text(json.dumps({"traceEvents": metadata + events, "displayTimeUnit": "ms"}))
+    os.replace(tmp_path, _path)
+    print(f"Trace written to {_path}")
+
+
+if os.environ.get(TRACE_ENV):
+    enable(Path(os.environ[TRACE_ENV]))
@@ -14,3 +14,30 @@ def join_os_environ(*args) -> dict[str, str]:
             else:
                 result[k_upper] = v
     return result
+
+
+SIZE_SUFFIXES = {
+    "": 1,
+    "K": 1 << 10,
+    "M": 1 << 20,
+    "G": 1 << 30,
+    "T": 1 << 40,
+}
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper().removesuffix("B")
+    number = text.rstrip("".join(SIZE_SUFFIXES))
+    suffix = text[len(number):]
+    if suffix not in SIZE_SUFFIXES:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(number) * SIZE_SUFFIXES[suffix])
+
+
+def format_size(size: int) -> str:
+    if size < 1024:
+        return f"{size} B"
+    for suffix in ("KiB", "MiB", "GiB", "TiB"):
+        size /= 1024
+        if size < 1024 or suffix == "TiB":
+            return f"{size:.1f} {suffix}"
@@ -1 +1 @@
-%~dp0\python.exe -m rec2_bisect --action run
+%~dp0\python.exe -m rec2_bisect --action run %*
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+import argparse
+import dataclasses
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Optional
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from rec2_bisect.git_util import git_log, git_session, git_show_commit, read_git_head
+from rec2_bisect.rec2 import REC2, REC2_DLL_NAME, REC2_INJECTOR_EXE_NAME
+from rec2_bisect.util import join_os_environ
+
+BUILD_HISTORY_PY = PROJECT_ROOT / "scripts/build_history.py"
+# Point lookups per run of the git latency benchmarks
+GIT_LOOKUPS = 100
+# Resolves the run command of a cached HEAD in a fresh interpreter, like `run.bat` does before spawning the injector
+FAST_PATH_SCRIPT = """
+import sys
+from pathlib import Path
+sys.path.insert(0, {root!r})
+from rec2_bisect.rec2 import REC2
+rec2 = REC2(source_path=Path({source!r}), build_path=Path({source!r}) / "build", cache_path=Path({cache!r}),
+            game_path=Path({source!r}), run_args=[], windbg_path=None)
+assert rec2.cached_run_cmd([])
+"""
+# Imports of the slow path: dependency probing and toolchain setup
+SLOW_PATH_IMPORTS = "import sys; sys.path.insert(0, {root!r}); import rec2_bisect.rec2, rec2_bisect.dep_manager, rec2_bisect.download"
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "Bench", "GIT_AUTHOR_EMAIL": "bench@example.com",
+    "GIT_COMMITTER_NAME": "Bench", "GIT_COMMITTER_EMAIL": "bench@example.com",
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class RepoShape:
+    commits: int
+    files: int
+    changes: int
+    diff_lines: int
+    seed: int
+
+
+def _fast_import_data(out: list[bytes], data: bytes) -> None:
+    out.append(b"data %d\n" % len(data))
+    out.append(data)
+    out.append(b"\n")
+
+
+def create_repo(path: Path, shape: RepoShape) -> None:
+    """Synthetic history through `git fast-import`: every commit rewrites diff_lines lines in `changes` files"""
+    rng = random.Random(shape.seed)
+    subprocess.check_call(["git", "init", "-q", str(path)])
+    subprocess.check_call(["git", "symbolic-ref", "HEAD", "refs/heads/master"], cwd=path)
+    lines_per_file = max(shape.diff_lines * 4, 64)
+    files = {
+        f"src/module{i % 16}/file{i}.c": [f"int f{i}_{j}(void) {{ return {j}; }}\n" for j in range(lines_per_file)]
+        for i in range(shape.files)
+    }
+    names = sorted(files)
+    stream: list[bytes] = []
+    timestamp = 1_500_000_000
+    for mark in range(1, shape.commits + 1):
+        if mark == 1:
+            changed = {"CMakeLists.txt": "project(rec2 C)\n", **{name: "".join(files[name]) for name in names}}
+        else:
+            changed = {}
+            for name in rng.sample(names, min(shape.changes, len(names))):
+                lines = files[name]
+                for _ in range(shape.diff_lines):
+                    lines[rng.randrange(len(lines))] = f"int g{mark}_{rng.randrange(1 << 30)}(void) {{ return {mark}; }}\n"
+                changed[name] = "".join(lines)
+            if mark % 10 == 0:
+                # Changes outside the build inputs: commits that share their build with their parent
+                changed = {"docs/notes.md": f"Note {mark}\n"}
+        stream.append(b"commit refs/heads/master\n")
+        stream.append(b"mark :%d\n" % mark)
+        stream.append(b"committer Bench <bench@example.com> %d +0000\n" % (timestamp + mark * 60))
+        _fast_import_data(stream, f"Commit {mark}\n\nChanges {len(changed)} files.\n".encode())
+        if mark > 1:
+            stream.append(b"from :%d\n" % (mark - 1))
+        for name, content in changed.items():
+            stream.append(f"M 100644 inline {name}\n".encode())
+            _fast_import_data(stream, content.encode())
+        stream.append(b"\n")
+    subprocess.run(["git", "fast-import", "--quiet"], input=b"".join(stream), cwd=path, check=True)
+    subprocess.check_call(["git", "checkout", "-q", "-f", "master"], cwd=path)
+
+
+def measure(repeat: int, fn: Callable[[], object]) -> list[float]:
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def run_benchmarks(workdir: Path, shape: RepoShape, repeat: int, sweep_commits: int) -> dict[str, dict]:
+    source = workdir / "source"
+    print(f"[ ] Creating a repository of {shape.commits} commits ...")
+    start = time.perf_counter()
+    create_repo(source, shape)
+    print(f"[x] Creating the repository took {time.perf_counter() - start:.1f}s")
+    commits = [commit.hash for commit in git_log(source, "master")]
+    head = read_git_head(source)
+
+    results: dict[str, dict] = {}
+
+    def bench(name: str, items: int, fn: Callable[[], object], count: Optional[int] = None) -> None:
+        runs = measure(count or repeat, fn)
+        results[name] = {"runs": runs, "min": min(runs), "median": statistics.median(runs), "items": items}
+        print(f"{name:<40}{min(runs) * 1000:10.3f} ms (min) {statistics.median(runs) * 1000:10.3f} ms (median)")
+
+    bench("git_log", len(commits), lambda: git_log(source, "master"))
+    # Latency of resolving HEAD and reading a commit: a git subprocess, the cat-file session, or the .git files
+    bench("git_rev_parse_subprocess", GIT_LOOKUPS, lambda: [
+        subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=source) for _ in range(GIT_LOOKUPS)])
+    session = git_session(source)
+    bench("git_session_rev_parse", GIT_LOOKUPS, lambda: [session.rev_parse("HEAD") for _ in range(GIT_LOOKUPS)])
+    bench("git_session_read_commit", GIT_LOOKUPS, lambda: [session.read_commit(commit) for commit in commits[:GIT_LOOKUPS]])
+    bench("read_git_head", GIT_LOOKUPS, lambda: [read_git_head(source) for _ in range(GIT_LOOKUPS)])
+    sample = commits[::max(1, len(commits) // 50)]
+    bench("git_show_commit", len(sample), lambda: [git_show_commit(source, commit) for commit in sample])
+    envs = [{"PATH": f"/opt/tool{i}/bin", "INCLUDE": f"/opt/tool{i}/include", "LIB": f"/opt/tool{i}/lib"} for i in range(4)]
+    bench("join_os_environ", 1000, lambda: [join_os_environ(*envs) for _ in range(1000)])
+
+    def new_rec2(cache_path: Path) -> REC2:
+        return REC2(source_path=source, build_path=workdir / "build", cache_path=cache_path, game_path=workdir,
+                    run_args=[], windbg_path=None)
+
+    # Cache resolution: tree keys of every commit (first lookup), then through the commit aliases
+    cache_runs = iter(range(repeat))
+
+    def cache_key_cold() -> None:
+        cold = new_rec2(workdir / f"cache-{next(cache_runs)}")
+        for commit in commits:
+            cold.cache_key(commit)
+
+    bench("cache_key_cold", len(commits), cache_key_cold)
+    rec2 = new_rec2(workdir / "cache-0")
+    bench("has_cached_build_warm", len(commits), lambda: [rec2.has_cached_build(commit) for commit in commits])
+    artifacts_path = workdir / "artifacts"
+    artifacts_path.mkdir()
+    for name in (REC2_DLL_NAME, REC2_INJECTOR_EXE_NAME):
+        (artifacts_path / name).write_bytes(random.Random(name).randbytes(1 << 20))
+    rec2.artifact_cache.store(rec2.cache_key(head), [artifacts_path / REC2_DLL_NAME,
+                                                     artifacts_path / REC2_INJECTOR_EXE_NAME], commit=head)
+    bench("cached_run_cmd", 1, lambda: rec2.cached_run_cmd([]))
+
+    # Startup of `run.bat` for a cached build: fresh interpreters
+    fast_path = FAST_PATH_SCRIPT.format(root=str(PROJECT_ROOT), source=str(source), cache=str(workdir / "cache-0"))
+    bench("startup_bare_python", 1, lambda: subprocess.check_call([sys.executable, "-c", "pass"]))
+    bench("startup_slow_path_imports", 1, lambda: subprocess.check_call(
+        [sys.executable, "-c", SLOW_PATH_IMPORTS.format(root=str(PROJECT_ROOT))]))
+    bench("startup_cached_run", 1, lambda: subprocess.check_call([sys.executable, "-c", fast_path]))
+
+    # Sweep orchestration: build_history.py with a build command that does nothing
+    sweep_runs = iter(range(repeat))
+
+    def sweep() -> None:
+        run = next(sweep_runs)
+        subprocess.check_call([
+            sys.executable, str(BUILD_HISTORY_PY),
+            "--source", str(source), "--build", str(workdir / f"sweep-{run}" / "build"),
+            "--ref", f"master~{max(0, len(commits) - sweep_commits)}" if len(commits) > sweep_commits else "master",
+            "--log", str(workdir / f"sweep-{run}.log"), "--what", "checks",
+            "--build-command", f'"{sys.executable}" -c pass',
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.check_call(["git", "checkout", "-q", "-f", "master"], cwd=source)
+
+    bench("build_history_dry_run", min(sweep_commits, len(commits)), sweep, count=min(repeat, 3))
+    return results
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=PROJECT_ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def compare(old_path: Path, new_path: Path, max_slowdown: Optional[float]) -> int:
+    old = json.loads(old_path.read_text())
+    new = json.loads(new_path.read_text())
+    print(f"old: {old['meta'].get('revision')}  new: {new['meta'].get('revision')}")
+    if old["meta"].get("shape") != new["meta"].get("shape"):
+        print("[!] The results were measured on differently shaped repositories")
+    regressions = []
+    for name, new_result in new["benchmarks"].items():
+        old_result = old["benchmarks"].get(name)
+        if old_result is None:
+            print(f"{name:<40}{'':>12}{new_result['median'] * 1000:12.3f} ms  (new)")
+            continue
+        ratio = new_result["median"] / old_result["median"] if old_result["median"] else float("inf")
+        print(f"{name:<40}{old_result['median'] * 1000:12.3f} ms{new_result['median'] * 1000:12.3f} ms  {ratio:6.2f}x")
+        if max_slowdown is not None and ratio > max_slowdown:
+            regressions.append(name)
+    if regressions:
+        print(f"[!] Slower than {max_slowdown}x: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(allow_abbrev=False, description="Benchmarks on synthetic git repositories")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks and write the results as JSON")
+    run_parser.add_argument("--output", type=Path, required=True, help="Results (JSON)")
+    run_parser.add_argument("--commits", type=int, default=2000, help="Commits of the synthetic repository")
+    run_parser.add_argument("--files", type=int, default=200, help="Source files of the synthetic repository")
+    run_parser.add_argument("--changes", type=int, default=5, help="Files changed by every commit")
+    run_parser.add_argument("--diff-lines", type=int, default=50, help="Lines changed in every changed file")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark")
+    run_parser.add_argument("--sweep-commits", type=int, default=50, help="Commits swept by build_history.py")
+    run_parser.add_argument("--workdir", type=Path, help="Keep the repositories here (default: temporary directory)")
+    compare_parser = subparsers.add_parser("compare", help="Compare two results files")
+    compare_parser.add_argument("old", type=Path)
+    compare_parser.add_argument("new", type=Path)
+    compare_parser.add_argument("--max-slowdown", type=float,
+                                help="Exit with 1 when a benchmark became slower by more than this factor")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        return compare(args.old, args.new, args.max_slowdown)
+
+    os.environ.update(GIT_ENV)
+    shape = RepoShape(commits=args.commits, files=args.files, changes=args.changes, diff_lines=args.diff_lines,
+                      seed=args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or Path(tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        benchmarks = run_benchmarks(workdir.resolve(), shape, args.repeat, args.sweep_commits)
+    git_version = subprocess.check_output(["git", "--version"], text=True).strip()
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "git": git_version,
+            "shape": dataclasses.asdict(shape),
+            "repeat": args.repeat,
+        },
+        "benchmarks": benchmarks,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
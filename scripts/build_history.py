@@ -1,68 +1,486 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
+import dataclasses
+import os
 from pathlib import Path
 import subprocess
 import sys
-from typing import IO
+import threading
+import time
+from typing import IO, Optional
 
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
 
-def main():
-    parser = argparse.ArgumentParser(allow_abbrev=True)
-    parser.add_argument("--source", required=True, type=Path)
-    parser.add_argument("--build", required=True, type=Path)
-    parser.add_argument("--commits", required=True, type=Path)
-    parser.add_argument("--log", required=True, type=Path)
-    parser.add_argument("--what", choices=("msvc", "mingw", "checks"), required=True)
-    args = parser.parse_args()
+from rec2_bisect import trace
+from rec2_bisect.build_results import BuildResults
+from rec2_bisect.commit_index import CommitIndex
+from rec2_bisect.git_util import git_hash, git_rev_parse
+from rec2_bisect.ninja_log import ninja_log_position, read_ninja_log
+from rec2_bisect.packages.ccache import (CCACHE_EXE_PATH, CCACHE_MSVC_CONFIGURE_ARGS, CcacheConfig, ccache_env,
+                                         ccache_launcher_args)
+from rec2_bisect.source_key import SourceKeys
+
+SOURCE_SUFFIXES = (".c", ".cc", ".cpp", ".cxx")
+CODE_SUFFIXES = SOURCE_SUFFIXES + (".h", ".hh", ".hpp", ".hxx", ".inc", ".cmake", "CMakeLists.txt")
+SCHEDULE_CANDIDATES = 8
+# Size columns of the results, and the artifact they measure
+ARTIFACT_SIZES = {
+    "dll_size": "rec2.dll",
+    "pdb_size": "rec2.pdb",
+    "injector_size": "rec2-injector.exe",
+}
+# ninja output of the edge re-running cmake when the build files changed
+NINJA_REGENERATE_OUTPUT = "build.ninja"
+
+
+@dataclasses.dataclass(frozen=True)
+class SweepCommit:
+    position: int
+    hash: str
+    subject: str
+
+
+class ChangedFiles:
+    """Cache of `git diff --name-only` between pairs of commits"""
+    def __init__(self):
+        self.cache: dict[tuple[str, str], list[str]] = {}
+
+    def get(self, source: Path, old: str, new: str) -> list[str]:
+        key = (old, new) if old < new else (new, old)
+        if key not in self.cache:
+            with trace.span("git diff --name-only", "git"):
+                self.cache[key] = subprocess.check_output(["git", "diff", "--name-only", old, new], cwd=source,
+                                                          text=True).splitlines()
+        return self.cache[key]
+
+    def code_files(self, source: Path, old: str, new: str) -> int:
+        return sum(1 for f in self.get(source, old, new) if f.endswith(CODE_SUFFIXES))
+
+    def source_files(self, source: Path, old: str, new: str) -> int:
+        return sum(1 for f in self.get(source, old, new) if f.endswith(SOURCE_SUFFIXES))
+
+
+class OrderedLog:
+    def __init__(self, fl: IO, count: int):
+        self.fl = fl
+        self.messages: list[str | None] = [None] * count
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def report(self, index: int, msg: str) -> None:
+        with self.lock:
+            self.messages[index] = msg
+            while self.next_index < len(self.messages) and self.messages[self.next_index] is not None:
+                msg = self.messages[self.next_index]
+                print(msg)
+                print(msg, file=self.fl)
+                self.next_index += 1
+            self.fl.flush()
+
+
+@dataclasses.dataclass
+class Sweep:
+    what: str
+    log: OrderedLog
+    results: BuildResults
+    schedule: str
+    parents: dict[str, tuple[str, ...]]
+    source_keys: SourceKeys
+    build_command: Optional[str] = None
+    configure_args: list[str] = dataclasses.field(default_factory=list)
+    artifact_paths: dict[tuple[Path, str], Path] = dataclasses.field(default_factory=dict)
+    changed_files: ChangedFiles = dataclasses.field(default_factory=ChangedFiles)
+    estimated_tus: int = 0
+    actual_tus: int = 0
+    chronological_tus: int = 0
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock)
+
+    def add_totals(self, estimated_tus: Optional[int], actual_tus: Optional[int]) -> None:
+        with self.lock:
+            self.estimated_tus += estimated_tus or 0
+            self.actual_tus += actual_tus or 0
+
+
+def schedule_by_diff(source: Path, items: list[tuple[int, SweepCommit]], sweep: Sweep) -> list[tuple[int, SweepCommit]]:
+    """
+    Order the commits so that every checkout changes as few code files as possible.
+
+    Walk the commit graph from the oldest commit: the next commit is picked from the unvisited parents and
+    children of recently built commits, by the smallest diff to the current checkout.
+    Without such neighbours, continue with the oldest unbuilt commit.
+    """
+    by_hash = {commit.hash: (index, commit) for index, commit in items}
+    neighbors: dict[str, set[str]] = {commit_hash: set() for commit_hash in by_hash}
+    for commit_hash in by_hash:
+        for parent in sweep.parents.get(commit_hash, ()):
+            if parent in by_hash:
+                neighbors[commit_hash].add(parent)
+                neighbors[parent].add(commit_hash)
+    unvisited = dict(by_hash)
+    frontier: dict[str, int] = {}
+    order = []
+    current = items[0][1].hash
+    while True:
+        order.append(unvisited.pop(current))
+        frontier.pop(current, None)
+        for neighbor in neighbors[current]:
+            if neighbor in unvisited:
+                frontier[neighbor] = len(order)
+        if not unvisited:
+            break
+        if not frontier:
+            current = next(iter(unvisited))
+            continue
+        candidates = sorted(frontier, key=lambda h: -frontier[h])[:SCHEDULE_CANDIDATES]
+        current = min(candidates, key=lambda h: (sweep.changed_files.code_files(source, current, h), by_hash[h][0]))
+    return order
+
+
+def split_contiguous(items: list, count: int) -> list[tuple[int, list]]:
+    chunk_size, remainder = divmod(len(items), count)
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + chunk_size + (1 if i < remainder else 0)
+        if end > start:
+            chunks.append((start, items[start:end]))
+        start = end
+    return chunks
+
+
+def shard_commits(commits: list[SweepCommit], shard: int, shards: int) -> list[SweepCommit]:
+    """
+    Contiguous range of shard (1-based) of shards balanced ranges of commits.
+
+    Except for the first shard, the range starts with the last commit of the previous shard: the build
+    directory is warmed up by it, and the transition into the first commit of the shard is built as usual.
+    """
+    size, remainder = divmod(len(commits), shards)
+    start = (shard - 1) * size + min(shard - 1, remainder)
+    end = start + size + (1 if shard - 1 < remainder else 0)
+    if end == start:
+        return []
+    return commits[max(start - 1, 0):end]
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    shard, sep, shards = value.partition("/")
+    try:
+        shard, shards = int(shard), int(shards)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value!r} is not I/N") from None
+    if not sep or not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError(f"{value!r} is not I/N with 1 <= I <= N")
+    return shard, shards
 
-    with args.commits.open() as f:
-        f: IO
-        lines = f.readlines()
-        lines.reverse()
 
-    if args.what == "mingw":
-        mingw_cmake_toolchain_path = (args.source / "cmake/toolchains/mingw32.cmake").resolve()
+@trace.traced("configure", "subprocess")
+def configure(what: str, source: Path, build: Path, extra_args: list[str]) -> None:
+    if what == "mingw":
+        mingw_cmake_toolchain_path = (source / "cmake/toolchains/mingw32.cmake").resolve()
         assert mingw_cmake_toolchain_path.is_file(), f"{mingw_cmake_toolchain_path} should exist"
         subprocess.check_call([
-            "cmake", "-S", str(args.source), "-B", str(args.build), "-GNinja",
+            "cmake", "-S", str(source), "-B", str(build), "-GNinja",
             "-DREC2_WERROR=ON",
             f"-DCMAKE_TOOLCHAIN_FILE={mingw_cmake_toolchain_path}",
-        ])
-    elif args.what == "msvc":
+        ] + extra_args)
+    elif what == "msvc":
         subprocess.check_call([
-            "cmake", "-S", str(args.source), "-B", str(args.build), "-GNinja",
+            "cmake", "-S", str(source), "-B", str(build), "-GNinja",
             "-DREC2_WERROR=ON",
             "-DCMAKE_C_COMPILER=cl",
             "-DCMAKE_CXX_COMPILER=cl",
-        ])
+        ] + extra_args)
+
+
+def checkout(source: Path, commit: str) -> None:
+    with trace.span("git checkout", "git"):
+        subprocess.check_call(["git", "checkout", commit], cwd=source)
+
+
+def build_commit(what: str, source: Path, build: Path, build_command: Optional[str] = None) -> tuple[str, Optional[int]]:
+    try:
+        if build_command:
+            with trace.span("build command", "subprocess"):
+                subprocess.check_call(build_command, shell=True, cwd=source)
+            return "OK", 0
+        if what in ("mingw", "msvc"):
+            with trace.span("cmake --build", "subprocess"):
+                subprocess.check_call(["cmake", "--build", build])
+            return "OK", 0
+        path_collect_symbols_py = source / "scripts/collect-symbols.py"
+        if path_collect_symbols_py.is_file():
+            with trace.span("collect-symbols.py", "subprocess"):
+                subprocess.check_call([
+                    sys.executable, str(path_collect_symbols_py), "-Werror",
+                ])
+            return "OK", 0
+        return "SKIP", None
+    except subprocess.CalledProcessError as e:
+        return "FAIL", e.returncode
+    except subprocess.SubprocessError:
+        return "FAIL", None
+
+
+def artifact_sizes(sweep: Sweep, build: Path) -> dict[str, Optional[int]]:
+    sizes = {}
+    for column, name in ARTIFACT_SIZES.items():
+        path = sweep.artifact_paths.get((build, name))
+        if path is None or not path.is_file():
+            # The output directory depends on the CMake project: look the artifact up once per build directory
+            path = next(build.rglob(name), None)
+            if path is not None:
+                sweep.artifact_paths[(build, name)] = path
+        sizes[column] = path.stat().st_size if path is not None else None
+    return sizes
+
+
+def build_sweep_commit(sweep: Sweep, source: Path, build: Path, index: int, commit: SweepCommit,
+                       previous: str, configure_duration: float) -> bool:
+    """
+    Build one commit of the sweep, or reuse the result of a commit with the same build inputs.
+
+    Returns whether the commit was built (and is checked out now). configure_duration is the time
+    spent configuring the build directory before this commit.
+    """
+    with trace.span("source key", "cache"):
+        tree_key = sweep.source_keys.key(commit.hash)
+    same_tree = sweep.results.find_tree_key(sweep.what, tree_key, exclude=commit.hash)
+    if same_tree:
+        print(f"{commit.hash} has the same build inputs as {same_tree.hash}: reusing its result")
+        result = sweep.results.record(commit.hash, sweep.what, commit.position, commit.subject, same_tree.outcome,
+                                      0.0, same_tree.exit_code, estimated_tus=0, actual_tus=0, tree_key=tree_key,
+                                      dll_size=same_tree.dll_size, pdb_size=same_tree.pdb_size,
+                                      injector_size=same_tree.injector_size)
+        sweep.log.report(index, result.log_line)
+        return False
+    estimated_tus = sweep.changed_files.source_files(source, previous, commit.hash)
+    log_position = ninja_log_position(build)
+    start = time.monotonic()
+    checkout(source, commit.hash)
+    checkout_duration = time.monotonic() - start
+    outcome, exit_code = build_commit(sweep.what, source, build, sweep.build_command)
+    duration = time.monotonic() - start + configure_duration
+    build_duration = duration - checkout_duration - configure_duration
+    actual_tus = None
+    sizes = {}
+    if sweep.what in ("mingw", "msvc") and not sweep.build_command:
+        # None: ninja recompacted its log, the entries of this build are unknown
+        entries = read_ninja_log(build, log_position)
+        if entries is not None:
+            actual_tus = sum(1 for entry in entries if entry.is_object)
+            sweep.results.record_ninja_log(commit.hash, sweep.what, entries)
+        else:
+            entries = []
+        # cmake re-runs inside `cmake --build` when CMakeLists.txt changed: count it as configure time
+        regenerate_duration = sum(entry.duration_ms for entry in entries
+                                  if entry.output == NINJA_REGENERATE_OUTPUT) / 1000
+        configure_duration += regenerate_duration
+        build_duration -= regenerate_duration
+        if outcome == "OK":
+            sizes = artifact_sizes(sweep, build)
+    sweep.add_totals(estimated_tus, actual_tus)
+    result = sweep.results.record(commit.hash, sweep.what, commit.position, commit.subject, outcome, duration,
+                                  exit_code, estimated_tus=estimated_tus, actual_tus=actual_tus,
+                                  tree_key=tree_key, checkout_duration=checkout_duration,
+                                  configure_duration=configure_duration, build_duration=build_duration, **sizes)
+    sweep.log.report(index, result.log_line)
+    return True
+
+
+def build_commits(sweep: Sweep, source: Path, build: Path, commits: list[SweepCommit], first_index: int) -> None:
+    if not commits:
+        return
+    items = list(enumerate(commits, start=first_index))
+    if sweep.schedule == "graph":
+        with trace.span("schedule by diff", "sweep"):
+            items = schedule_by_diff(source, items, sweep)
+        chronological_tus = sum(sweep.changed_files.source_files(source, old.hash, new.hash)
+                                for old, new in zip(commits, commits[1:]))
+        with sweep.lock:
+            sweep.chronological_tus += chronological_tus
+    configure_duration = 0.0
+    if git_hash(source) != items[0][1].hash:
+        # Configure at the first commit, so building it does not re-run cmake
+        checkout(source, items[0][1].hash)
+    if not sweep.build_command:
+        start = time.monotonic()
+        configure(sweep.what, source, build, sweep.configure_args)
+        configure_duration = time.monotonic() - start
+    previous = git_hash(source)
+    for index, commit in items:
+        with trace.span(f"commit {commit.position}", "sweep", hash=commit.hash, subject=commit.subject):
+            if build_sweep_commit(sweep, source, build, index, commit, previous, configure_duration):
+                previous = commit.hash
+                # The configure time is attributed to the first commit built in the directory
+                configure_duration = 0.0
+
+
+def build_commits_parallel(args: argparse.Namespace, commits: list[SweepCommit], sweep: Sweep) -> None:
+    # Every worker gets its own worktree + build directory and a contiguous run of commits,
+    # so each one still benefits from incremental builds.
+    workers = []
+    for i, (first_index, chunk) in enumerate(split_contiguous(commits, args.jobs)):
+        worktree = args.build.parent / f"{args.build.name}-worktree-{i}"
+        build = args.build.parent / f"{args.build.name}-{i}"
+        with trace.span("create worktree", "git", worktree=worktree):
+            subprocess.check_call(["git", "worktree", "add", "--force", "--detach", str(worktree.resolve()),
+                                   chunk[0].hash], cwd=args.source)
+            subprocess.check_call(["git", "submodule", "update", "--init", "--recursive"], cwd=worktree)
+        workers.append((worktree, build, first_index, chunk))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            futures = [
+                executor.submit(build_commits, sweep, worktree, build, chunk, first_index)
+                for worktree, build, first_index, chunk in workers
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        for worktree, _, _, _ in workers:
+            subprocess.call(["git", "worktree", "remove", "--force", str(worktree.resolve())], cwd=args.source)
+
+
+def merge_main(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(prog="build_history.py merge", allow_abbrev=False,
+                                     description="Merge the results of sharded sweeps (--shard) into one log")
+    parser.add_argument("--log", required=True, type=Path, help="Merged log (overwritten)")
+    parser.add_argument("--db", type=Path, help="Merged results database (default: <log>.sqlite)")
+    parser.add_argument("shard_dbs", metavar="SHARD_DB", nargs="+", type=Path, help="Results databases of the shards")
+    args = parser.parse_args(argv)
+
+    for shard_db in args.shard_dbs:
+        if not shard_db.is_file():
+            parser.error(f"{shard_db} does not exist")
+    # Shards in commit order: a commit built by two shards (the overlap) keeps the result of the shard owning it,
+    # which built it incrementally
+    shard_starts = {}
+    for shard_db in args.shard_dbs:
+        shard_results = BuildResults(shard_db)
+        shard_starts[shard_db] = min((result.position for result in shard_results.results()), default=0)
+        shard_results.close()
+    results = BuildResults(args.db or args.log.with_suffix(".sqlite"))
+    for shard_db in sorted(args.shard_dbs, key=lambda path: shard_starts[path]):
+        count = results.merge(shard_db)
+        print(f"{shard_db}: {count} results")
+    merged = results.results()
+    results.close()
+    with args.log.open("w") as fl:
+        for result in merged:
+            print(result.log_line, file=fl)
+    print(f"Merged {len(merged)} results into {args.log}")
+
+
+def main():
+    if sys.argv[1:2] == ["merge"]:
+        return merge_main(sys.argv[2:])
+    parser = argparse.ArgumentParser(allow_abbrev=True,
+                                     epilog="Use `build_history.py merge --help` to merge the results of shards")
+    parser.add_argument("--source", required=True, type=Path)
+    parser.add_argument("--build", required=True, type=Path)
+    commits_group = parser.add_mutually_exclusive_group(required=True)
+    commits_group.add_argument("--commits", type=Path, help="Text file with '<hash> <subject>' lines, newest first")
+    commits_group.add_argument("--ref", help="Build the history of this ref, read from the commit index")
+    parser.add_argument("--index", type=Path,
+                        help="Commit index database, updated incrementally (default: <build>.commits.sqlite)")
+    parser.add_argument("--log", required=True, type=Path)
+    parser.add_argument("--db", type=Path, help="Build results database (default: <log>.sqlite)")
+    parser.add_argument("--rebuild", action="store_true", help="Also build commits that already have a result")
+    parser.add_argument("--what", choices=("msvc", "mingw", "checks"), required=True)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of git worktrees building commits in parallel (default: 1)")
+    parser.add_argument("--schedule", choices=("chronological", "graph"), default="chronological",
+                        help="Build order: oldest first, or following the commit graph with the smallest diffs")
+    parser.add_argument("--ccache", action="store_true",
+                        help="Compile through the ccache of rec2_bisect, with [ccache] path and max_size of config.ini")
+    parser.add_argument("--build-command", metavar="CMD",
+                        help="Run this shell command in the checkout instead of configuring and building "
+                             "(e.g. a stub command to measure the sweep itself)")
+    parser.add_argument("--shard", metavar="I/N", type=parse_shard,
+                        help="Only build shard I (1-based) of N contiguous, balanced ranges of the commits")
+    parser.add_argument("--trace", metavar="PATH", type=Path,
+                        help=f"Write a Chrome trace of the sweep to PATH (or set {trace.TRACE_ENV})")
+    args = parser.parse_args()
+    if args.trace:
+        trace.enable(args.trace)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    args.configure_args = []
+    if args.ccache:
+        # The same ccache, directory and size limit as bisect builds ([ccache] of config.ini)
+        ccache_config = CcacheConfig.load()
+        if not ccache_config.enabled:
+            parser.error("--ccache requires [ccache] enabled = true in config.ini (then run download.bat)")
+        try:
+            args.configure_args += ccache_launcher_args()
+        except FileNotFoundError as e:
+            parser.error(str(e))
+        if args.what == "msvc":
+            args.configure_args += CCACHE_MSVC_CONFIGURE_ARGS
+        # Hash paths relative to a common base, so the main checkout and all worktrees share cache entries
+        base_dir = Path(os.path.commonpath([args.source.resolve(), args.build.resolve().parent]))
+        os.environ.update(ccache_env(ccache_config.path, ccache_config.max_size, base_dir))
+
+    if args.commits:
+        with args.commits.open() as f:
+            f: IO
+            lines = [line.strip() for line in f.readlines() if line.strip()]
+    index = None
+    if args.ref or args.schedule == "graph":
+        index = CommitIndex(args.index or args.build.parent / f"{args.build.name}.commits.sqlite", args.source)
+    if args.ref:
+        with trace.span("update commit index", "git"):
+            index.update(args.ref)
+        lines = [f"{commit.hash} {commit.subject}" for commit in index.log(git_rev_parse(args.source, args.ref))]
+    lines.reverse()
+    commits = [SweepCommit(position, *line.split(" ", 1)) for position, line in enumerate(lines)]
+    if args.shard:
+        commits = shard_commits(commits, *args.shard)
+        if commits:
+            print(f"Shard {args.shard[0]}/{args.shard[1]}: commits {commits[0].position} to {commits[-1].position} "
+                  f"({commits[0].hash} to {commits[-1].hash})")
+        else:
+            print(f"Shard {args.shard[0]}/{args.shard[1]}: no commits")
+    selected = len(commits)
+    parents = {}
+    if args.schedule == "graph" and commits:
+        with trace.span("update commit index", "git"):
+            index.update(commits[-1].hash)
+        parents = {commit.hash: tuple(index.parents(commit.hash)) for commit in commits}
+    if index:
+        index.close()
+
+    results = BuildResults(args.db or args.log.with_suffix(".sqlite"))
+    if not args.rebuild:
+        completed = results.completed(args.what)
+        commits = [commit for commit in commits if commit.hash not in completed]
+        if completed:
+            print(f"Skipping {selected - len(commits)} commits with a result (use --rebuild to build them again)")
 
     with args.log.open("a") as fl:
         fl: IO
-        for line in lines:
-            line = line.strip()
-            commit, descr = line.split(" ", 1)
-            subprocess.check_call(["git", "checkout", commit], cwd=args.source)
-            try:
-                if args.what in ("mingw", "msvc"):
-                    subprocess.check_call(["cmake", "--build", args.build])
-                    result = "OK"
-                else:
-                    path_collect_symbols_py = args.source / "scripts/collect-symbols.py"
-                    if path_collect_symbols_py.is_file():
-                        subprocess.check_call([
-                            sys.executable, str(path_collect_symbols_py), "-Werror",
-                        ])
-                        result = "OK"
-                    else:
-                        result = "SKIP"
-                msg = f"{result:<4} {commit} {descr}"
-
-            except subprocess.SubprocessError:
-                msg = f"FAIL {commit} {descr}"
-            print(msg)
-            print(msg, file=fl)
-            fl.flush()
+        sweep = Sweep(what=args.what, log=OrderedLog(fl, len(commits)), results=results, schedule=args.schedule,
+                      parents=parents, source_keys=SourceKeys(args.source), build_command=args.build_command,
+                      configure_args=args.configure_args)
+        if commits and args.jobs == 1:
+            build_commits(sweep, args.source, args.build, commits, 0)
+        elif commits:
+            build_commits_parallel(args, commits, sweep)
+    results.close()
+
+    if commits:
+        print(f"Changed source files between checkouts (estimated recompiled translation units): {sweep.estimated_tus}")
+        if args.schedule == "graph":
+            print(f"Changed source files in chronological order: {sweep.chronological_tus}")
+        if args.what in ("mingw", "msvc") and not args.build_command:
+            print(f"Recompiled translation units (from .ninja_log): {sweep.actual_tus}")
+
+    if args.ccache:
+        subprocess.call([str(CCACHE_EXE_PATH), "--show-stats"])
 
 
 if __name__ == "__main__":
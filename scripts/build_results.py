@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import dataclasses
+import json
+from pathlib import Path
+import statistics
+import sys
+from typing import Optional
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from rec2_bisect.build_results import METRICS, BuildResult, BuildResults
+
+
+def print_results(results: list[BuildResult]) -> None:
+    for result in results:
+        exit_code = "-" if result.exit_code is None else str(result.exit_code)
+        print(f"{result.what:<7} {result.position:>5} {result.duration:8.1f}s {exit_code:>4}  {result.log_line}")
+
+
+def metric_value(result: BuildResult, metric: str) -> Optional[float]:
+    value = getattr(result, metric)
+    if metric.endswith("duration") and (result.outcome != "OK" or not value):
+        # Failed builds stop early, and results reused from a commit with the same build inputs took no time
+        return None
+    return value
+
+
+def min_deltas(metrics: list[str], seconds: float, size: int) -> dict[str, float]:
+    """Minimum absolute change per metric: seconds for the durations, bytes for the sizes"""
+    return {metric: seconds if metric.endswith("duration") else size for metric in metrics}
+
+
+def find_regressions(results: list[BuildResult], metrics: list[str], threshold: float,
+                     window: int, min_delta: dict[str, float]) -> list[dict]:
+    """
+    Results where a metric exceeds the median of the previous `window` values by more than threshold (a fraction)
+    and by at least min_delta[metric], so jitter of short builds and tiny size changes are not reported
+    """
+    regressions = []
+    for metric in metrics:
+        history: list[float] = []
+        for result in results:
+            value = metric_value(result, metric)
+            if value is None:
+                continue
+            if len(history) >= min(window, 3):
+                baseline = statistics.median(history[-window:])
+                if (baseline > 0 and value > baseline * (1 + threshold)
+                        and value - baseline >= min_delta.get(metric, 0)):
+                    regressions.append({
+                        "what": result.what,
+                        "position": result.position,
+                        "hash": result.hash,
+                        "subject": result.subject,
+                        "metric": metric,
+                        "baseline": baseline,
+                        "value": value,
+                        "change": value / baseline - 1,
+                    })
+                    # Report a step change once: the new level becomes the baseline
+                    history = []
+            history.append(value)
+    regressions.sort(key=lambda regression: (regression["what"], regression["position"], regression["metric"]))
+    return regressions
+
+
+def export_results(results: list[BuildResult], fmt: str, out) -> None:
+    rows = [dataclasses.asdict(result) for result in results]
+    if fmt == "json":
+        json.dump(rows, out, indent=2)
+        out.write("\n")
+        return
+    writer = csv.DictWriter(out, fieldnames=[field.name for field in dataclasses.fields(BuildResult)])
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(allow_abbrev=False, description="Query results of build_history.py")
+    parser.add_argument("--db", required=True, type=Path, help="Build results database")
+    parser.add_argument("--what", choices=("msvc", "mingw", "checks"), help="Only show this toolchain")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_parser = subparsers.add_parser("list", help="List results in commit order")
+    list_parser.add_argument("--outcome", choices=("OK", "FAIL", "SKIP"), help="Only show this outcome")
+    subparsers.add_parser("first-fail", help="First FAIL after the last OK, per toolchain")
+    subparsers.add_parser("summary", help="Number of results per outcome, per toolchain")
+    regressions_parser = subparsers.add_parser(
+        "regressions", help="Commits where build time or artifact size grew past a threshold of a rolling baseline")
+    regressions_parser.add_argument("--metric", action="append", choices=METRICS,
+                                    help="Metric to check, can be repeated (default: all)")
+    regressions_parser.add_argument("--threshold", type=float, default=0.25,
+                                    help="Flag values above baseline * (1 + THRESHOLD) (default: 0.25)")
+    regressions_parser.add_argument("--min-delta-seconds", type=float, default=5.0,
+                                    help="Minimum growth of a duration in seconds (default: 5)")
+    regressions_parser.add_argument("--min-delta-bytes", type=int, default=64 * 1024,
+                                    help="Minimum growth of an artifact size in bytes (default: 65536)")
+    regressions_parser.add_argument("--window", type=int, default=10,
+                                    help="Baseline: median of this many previous values (default: 10)")
+    regressions_parser.add_argument("--json", action="store_true", help="Machine-readable output")
+    export_parser = subparsers.add_parser("export", help="Export all results with their metrics")
+    export_parser.add_argument("--format", choices=("csv", "json"), default="csv")
+    export_parser.add_argument("--output", type=Path, help="Output file (default: stdout)")
+    args = parser.parse_args()
+
+    if not args.db.is_file():
+        parser.error(f"{args.db} does not exist")
+    results = BuildResults(args.db)
+    toolchains = [args.what] if args.what else results.toolchains()
+    if args.command == "list":
+        print_results(results.results(what=args.what, outcome=args.outcome))
+    elif args.command == "first-fail":
+        for what in toolchains:
+            result = results.first_fail_after_last_ok(what)
+            print(f"{what:<7} {result.log_line if result else 'no FAIL after the last OK'}")
+    elif args.command == "summary":
+        for what in toolchains:
+            outcomes = [result.outcome for result in results.results(what=what)]
+            counts = ", ".join(f"{outcome} {outcomes.count(outcome)}" for outcome in ("OK", "FAIL", "SKIP"))
+            print(f"{what:<7} {counts}")
+    elif args.command == "regressions":
+        regressions = []
+        metrics = args.metric or list(METRICS)
+        min_delta = min_deltas(metrics, args.min_delta_seconds, args.min_delta_bytes)
+        for what in toolchains:
+            regressions += find_regressions(results.results(what=what), metrics, args.threshold, args.window,
+                                            min_delta)
+        if args.json:
+            print(json.dumps(regressions, indent=2))
+            regressions = []
+        for regression in regressions:
+            print(f"{regression['what']:<7} {regression['position']:>5} {regression['hash']} "
+                  f"{regression['metric']:<18} {regression['baseline']:>12.1f} -> {regression['value']:>12.1f} "
+                  f"(+{regression['change'] * 100:.0f}%)  {regression['subject']}")
+    elif args.command == "export":
+        selected = results.results(what=args.what)
+        if args.output:
+            with args.output.open("w", newline="") as f:
+                export_results(selected, args.format, f)
+        else:
+            export_results(selected, args.format, sys.stdout)
+    results.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
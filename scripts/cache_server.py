@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import argparse
+import functools
+import http.server
+import os
+from pathlib import Path
+import tempfile
+
+CHUNK_SIZE = 1 << 20
+
+
+class CacheRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """http.server with PUT: a remote cache ([remote_cache] url of config.ini) for a team or a test"""
+    def do_PUT(self):
+        path = Path(self.translate_path(self.path))
+        root = Path(self.directory).resolve()
+        if not path.resolve().is_relative_to(root) or self.path.endswith("/"):
+            self.send_error(403)
+            return
+        length = int(self.headers.get("Content-Length") or -1)
+        if length < 0:
+            self.send_error(411)
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while length:
+                    block = self.rfile.read(min(length, CHUNK_SIZE))
+                    if not block:
+                        raise ConnectionError("client disconnected")
+                    f.write(block)
+                    length -= len(block)
+            os.replace(tmp, path)
+        finally:
+            Path(tmp).unlink(missing_ok=True)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def main():
+    parser = argparse.ArgumentParser(allow_abbrev=False, description="Serve a directory as a remote artifact cache")
+    parser.add_argument("directory", type=Path, help="Cache directory")
+    parser.add_argument("--bind", default="127.0.0.1", help="Address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    args.directory.mkdir(parents=True, exist_ok=True)
+    handler = functools.partial(CacheRequestHandler, directory=str(args.directory))
+    with http.server.ThreadingHTTPServer((args.bind, args.port), handler) as server:
+        print(f"Serving {args.directory} as remote cache on http://{args.bind}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
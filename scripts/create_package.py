@@ -65,5 +65,6 @@ with zipfile.ZipFile(ZIP_PACKAGE_PATH, "w") as zf:
     zf.write(PROJECT_ROOT / "debug.bat", arcname=str(arc_root / "debug.bat"))
     zf.write(PROJECT_ROOT / "build.bat", arcname=str(arc_root / "build.bat"))
     zf.write(PROJECT_ROOT / "download.bat", arcname=str(arc_root / "download.bat"))
+    zf.write(PROJECT_ROOT / "bisect.bat", arcname=str(arc_root / "bisect.bat"))
 
 print(f"[X] Created {ZIP_PACKAGE_PATH}")
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+from pathlib import Path
+import statistics
+import sys
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from rec2_bisect.build_results import BuildResults, EdgeTiming
+from rec2_bisect.ninja_log import OBJECT_SUFFIXES
+
+
+def group_by_output(timings: list[EdgeTiming]) -> dict[str, list[EdgeTiming]]:
+    groups: dict[str, list[EdgeTiming]] = {}
+    for timing in timings:
+        groups.setdefault(timing.output, []).append(timing)
+    return groups
+
+
+def slowest(timings: list[EdgeTiming], count: int, sort: str) -> list[dict]:
+    rows = []
+    for output, edges in group_by_output(timings).items():
+        durations = [edge.duration_ms for edge in edges]
+        rows.append({
+            "output": output,
+            "builds": len(durations),
+            "total_ms": sum(durations),
+            "median_ms": statistics.median(durations),
+            "max_ms": max(durations),
+            "last_ms": durations[-1],
+        })
+    rows.sort(key=lambda row: row[f"{sort}_ms"], reverse=True)
+    return rows[:count]
+
+
+def trend(timings: list[EdgeTiming]) -> list[dict]:
+    return [{"output": t.output, "position": t.position, "hash": t.hash, "duration_ms": t.duration_ms} for t in timings]
+
+
+def regressions(timings: list[EdgeTiming], ratio: float, min_delta_ms: int) -> list[dict]:
+    """Commits after which an output took at least ratio times (and min_delta_ms) longer than its previous build"""
+    rows = []
+    for output, edges in group_by_output(timings).items():
+        for previous, edge in zip(edges, edges[1:]):
+            delta = edge.duration_ms - previous.duration_ms
+            if delta >= min_delta_ms and edge.duration_ms >= ratio * max(previous.duration_ms, 1):
+                rows.append({
+                    "output": output,
+                    "hash": edge.hash,
+                    "position": edge.position,
+                    "previous_hash": previous.hash,
+                    "previous_ms": previous.duration_ms,
+                    "duration_ms": edge.duration_ms,
+                    "delta_ms": delta,
+                })
+    rows.sort(key=lambda row: row["delta_ms"], reverse=True)
+    return rows
+
+
+def print_table(rows: list[dict]) -> None:
+    if not rows:
+        print("No recorded edges")
+        return
+    columns = list(rows[0])
+    widths = {column: max(len(column), *(len(format_cell(row[column])) for row in rows)) for column in columns}
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(format_cell(row[column]).rjust(widths[column]) if isinstance(row[column], (int, float))
+                        else format_cell(row[column]).ljust(widths[column]) for column in columns))
+
+
+def format_cell(value) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.0f}"
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(allow_abbrev=False,
+                                     description="Compile time hot spots from the .ninja_log entries recorded per commit")
+    parser.add_argument("--db", required=True, type=Path,
+                        help="Build results database of build_history.py, or <cache>/builds.sqlite of rec2_bisect")
+    parser.add_argument("--what", help="Only this toolchain (msvc, mingw, or rec2 for rec2_bisect builds)")
+    parser.add_argument("--all-edges", action="store_true", help="Also report link and custom command edges")
+    parser.add_argument("--json", action="store_true", help="Machine-readable output")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    slowest_parser = subparsers.add_parser("slowest", help="Slowest translation units over all recorded builds")
+    slowest_parser.add_argument("--count", type=int, default=20)
+    slowest_parser.add_argument("--sort", choices=("total", "median", "max", "last"), default="total",
+                                help="total is the time spent on the output over the whole history (default)")
+    trend_parser = subparsers.add_parser("trend", help="Compile time of outputs over history")
+    trend_parser.add_argument("output", help="Output path, or a part of it")
+    regressions_parser = subparsers.add_parser("regressions", help="Commits that made an output slower to build")
+    regressions_parser.add_argument("--output", help="Only outputs containing this text")
+    regressions_parser.add_argument("--ratio", type=float, default=1.25,
+                                    help="Minimum slowdown relative to the previous build (default: 1.25)")
+    regressions_parser.add_argument("--min-delta-ms", type=int, default=200,
+                                    help="Minimum slowdown in milliseconds (default: 200)")
+    args = parser.parse_args()
+
+    if not args.db.is_file():
+        parser.error(f"{args.db} does not exist")
+    results = BuildResults(args.db)
+    report = {}
+    for what in [args.what] if args.what else results.edge_toolchains():
+        timings = [t for t in results.edge_timings(what) if args.all_edges or t.output.endswith(OBJECT_SUFFIXES)]
+        if args.command == "slowest":
+            rows = slowest(timings, args.count, args.sort)
+        elif args.command == "trend":
+            rows = trend([t for t in timings if args.output in t.output])
+        else:
+            if args.output:
+                timings = [t for t in timings if args.output in t.output]
+            rows = regressions(timings, args.ratio, args.min_delta_ms)
+        report[what] = rows
+    results.close()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return 0
+    for what, rows in report.items():
+        print(f"== {what} ==")
+        print_table(rows)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+from pathlib import Path
+import re
+import sys
+import urllib.request
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from rec2_bisect.packages import ccache, cmake, git, ninja
+
+# (module, prefix of its <PREFIX>_URL and <PREFIX>_SHA256)
+PACKAGES = [(cmake, "CMAKE"), (git, "GIT"), (ninja, "NINJA"), (ccache, "CCACHE")]
+
+
+def url_sha256(url: str) -> str:
+    h = hashlib.sha256()
+    with urllib.request.urlopen(url) as stream:
+        while True:
+            block = stream.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(allow_abbrev=False,
+                                     description="Download the dependencies and pin their SHA-256 in rec2_bisect/packages")
+    parser.add_argument("--check", action="store_true",
+                        help="Only compare the pinned digests, exit with 1 on a mismatch or a missing digest")
+    args = parser.parse_args()
+
+    mismatches = 0
+    for module, prefix in PACKAGES:
+        url = getattr(module, f"{prefix}_URL")
+        pinned = getattr(module, f"{prefix}_SHA256")
+        if args.check and pinned is None:
+            # Needs no download, so the check also guards the pin table offline (e.g. in CI)
+            print(f"[!] {prefix}_SHA256 is not pinned")
+            mismatches += 1
+            continue
+        print(f"[ ] Downloading {url} ...")
+        digest = url_sha256(url)
+        if digest == pinned:
+            print(f"[x] {prefix}_SHA256 = {digest} (unchanged)")
+            continue
+        mismatches += 1
+        if args.check:
+            print(f"[!] {prefix}_SHA256 is {pinned}, the download is {digest}")
+            continue
+        module_path = Path(module.__file__)
+        text, count = re.subn(rf"^{prefix}_SHA256 = .*$", f'{prefix}_SHA256 = "{digest}"', module_path.read_text(),
+                              count=1, flags=re.M)
+        if not count:
+            raise ValueError(f"{module_path} has no {prefix}_SHA256")
+        module_path.write_text(text)
+        print(f"[x] {prefix}_SHA256 = {digest} (written to {module_path.name})")
+    return 1 if args.check and mismatches else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())